@@ -5,8 +5,26 @@
 ######################################################################
 
 # %% import statements
+import itertools
+import os
 import numpy as np
+import scipy.sparse as sp
+import scipy.sparse.linalg as spla
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    # CHOLMOD, if scikit-sparse is installed; otherwise SuperLU is used
+    from sksparse.cholmod import cholesky as cholmod_cholesky
+    from sksparse.cholmod import CholmodNotPositiveDefiniteError
+except ImportError:
+    cholmod_cholesky = None
+
+import matrix_cache
+import profiling
+import screening
+import sparse_params
+import work_queue
 
 # %% directories
 ACTIVE_LEARNING_DIR = "active_learning_sims"
@@ -15,10 +33,60 @@ GENERAL_PREFIX = "/mnt/c/Users/apare/Desktop/KimResearchGroup/Spring2022/"
 TO_CITRUSS = GENERAL_PREFIX + "mlcggm/Mega-sCGGM/citruss.py"
 TO_DATA = "input_simulation/simulateCodeTemp/"
 
+# number of individuals scored at a time in the out-of-core likelihood;
+# None keeps every matrix in memory
+CHUNK_SIZE = None
+
+# if set, grid points are submitted to this work_queue spool directory
+# instead of being fit here
+SPOOL_DIR = None
+
+# per-phase time/memory report (and cProfile dumps per grid point if
+# PSTATS_DIR is set); off by default
+PROFILE = False
+PSTATS_DIR = None
+
+# precision of the data and of the products with it in the likelihood;
+# np.float32 halves memory and bandwidth. Log-determinants and sums over
+# individuals always stay in float64. With CHECK_PRECISION, each grid
+# point is also scored in float64 and the BIC difference is reported;
+# that doubles the scoring time, so it is off except to validate float32.
+DTYPE = np.float64
+CHECK_PRECISION = False
+
+# a sparse V with a larger fraction of non-zeros than this is scored with
+# the dense inverse/determinant instead of a sparse factorisation
+SPARSE_V_DENSITY = 0.1
+
+# F and Psi are kept sparse for the per-individual products only if they
+# have at least SPARSE_FP_MIN_SIZE entries, at most SPARSE_FP_DENSITY of
+# them non-zero; otherwise they are densified once, as the sparse
+# products and column slices cost more than the dense ones
+SPARSE_FP_DENSITY = 0.05
+SPARSE_FP_MIN_SIZE = 1 << 16
+
+# number of folds for the held-out likelihood score computed alongside
+# BIC; None skips cross-validation
+CV_FOLDS = None
+
+# with SPOOL_DIR, score the fits the workers left under output_prefix + 
+# "{i}_" in one batch (see score_param_sets) instead of submitting the grid
+RESCORE = False
+
+# bytes of intermediate arrays score_param_sets may hold at once
+SCORE_MEMORY = 1 << 28
+
+# fit the genes in independent blocks, each with its own citruss run,
+# where the joint fit is block diagonal in V (see screening)
+SCREEN = False
+
 
 # %% main function
-def main():
+def main(chunk_size=CHUNK_SIZE, spool_dir=SPOOL_DIR, profile=PROFILE,
+         pstats_dir=PSTATS_DIR, dtype=DTYPE, check_precision=CHECK_PRECISION,
+         cv_folds=CV_FOLDS, rescore=RESCORE, screen=SCREEN):
     print("BIC Hyperparameter Selection")
+    profiler = profiling.Profiler(enabled=profile, pstats_dir=pstats_dir)
 
     fXm = GENERAL_PREFIX + TO_DATA + "missing35/Xm1.txt"
     fXp = GENERAL_PREFIX + TO_DATA + "missing35/Xp1.txt"
@@ -26,13 +94,28 @@ def main():
     fYp = GENERAL_PREFIX + TO_DATA + "missing35/Yp1.txt"
     fYsum = GENERAL_PREFIX + TO_DATA + "missing35/Ysum1.txt"
 
-    Xm = np.loadtxt(fXm)
-    Xp = np.loadtxt(fXp)
-    Xs = Xm + Xp
-
-    Ym = np.loadtxt(fYm)
-    Yp = np.loadtxt(fYp)
-    Ysum = np.loadtxt(fYsum)
+    with profiler.phase("load_data"):
+        if chunk_size is None:
+            Xm = matrix_cache.load_matrix(fXm, dtype)
+            Xp = matrix_cache.load_matrix(fXp, dtype)
+
+            Ym = matrix_cache.load_matrix(fYm, dtype)
+            Yp = matrix_cache.load_matrix(fYp, dtype)
+            Ysum = matrix_cache.load_matrix(fYsum, dtype)
+        else:
+            # convert once to binary and memory-map, so that only chunk_size
+            # rows of each matrix are ever resident while scoring
+            Xm = load_rows(text_to_npy(fXm, chunk_size=chunk_size,
+                                             dtype=dtype))
+            Xp = load_rows(text_to_npy(fXp, chunk_size=chunk_size,
+                                             dtype=dtype))
+
+            Ym = load_rows(text_to_npy(fYm, chunk_size=chunk_size,
+                                             dtype=dtype))
+            Yp = load_rows(text_to_npy(fYp, chunk_size=chunk_size,
+                                             dtype=dtype))
+            Ysum = load_rows(text_to_npy(fYsum, chunk_size=chunk_size,
+                                             dtype=dtype))
 
     # F = np.loadtxt("missing35/1F.txt")
     # V = np.loadtxt("missing35/1V.txt")
@@ -45,53 +128,230 @@ def main():
     regPsi = np.arange(0, 0.86, 0.05)
 
     output_prefix = GENERAL_PREFIX + TO_DATA + "BIC_selection/"
-    N, q = Xm.shape
-    _, p = Ym.shape
+
+    if spool_dir is not None and rescore:
+        with profiler.phase("score"):
+            print(rescore_BIC_grid(Xm, Xp, Ym, Yp, Ysum, regV, regF, regGamma,
+                                   regPsi, output_prefix, dtype=dtype))
+        profiler.report()
+        return
+
+    if spool_dir is not None:
+        submit_BIC_grid(spool_dir, fXm, fXp, fYm, fYp, fYsum,
+                        regV, regF, regGamma, regPsi, output_prefix,
+                        chunk_size=chunk_size, dtype=dtype,
+                        check_precision=check_precision, screen=screen)
+        return
+
+    # citruss takes q genes and p SNPs, as in submit_BIC_grid
+    N, q = Ysum.shape
+    _, p = Xm.shape
 
     bic_result = [None for _ in range(len(regV))]
     llik_results = [None for _ in range(len(regV))]
     for i in range(len(regV)):
+        profiler.next_iteration(i)
         bic_result[i] = get_BIC(fXm, fXp, fYm, fYp, fYsum, regV[i], regF[i], regGamma[i], regPsi[i],
-                                Xm, Xp, Ym, Yp, Ysum, output_prefix, N, q, p)
+                                Xm, Xp, Ym, Yp, Ysum, output_prefix, N, q, p,
+                                chunk_size=chunk_size, profiler=profiler,
+                                dtype=dtype, check_precision=check_precision,
+                                screen=screen)
 
     print(bic_result)
 
+    if cv_folds is not None:
+        # folds and their training files are made once for the whole grid
+        with profiler.phase("write_folds"):
+            folds = kfold_indices(Xm.shape[0], cv_folds)
+            fold_files = write_folds(Xm, Xp, Ym, Yp, Ysum, folds,
+                                     output_prefix, dtype=dtype)
+        cv_result = [None for _ in range(len(regV))]
+        for i in range(len(regV)):
+            with profiler.phase("cross_validation"):
+                cv_result[i] = get_CV(fold_files, folds, regV[i], regF[i],
+                                      regGamma[i], regPsi[i],
+                                      Xm, Xp, Ym, Yp, Ysum, output_prefix, q, p,
+                                      chunk_size=chunk_size, dtype=dtype,
+                                      screen=screen)[:2]
+        print(cv_result)
+
+    profiler.report()
+
 # %% BIC grid search
 
 
 def get_BIC(fXm, fXp, fYm, fYp, fYsum, regV, regF, regGamma, regPsi,
             Xm, Xp, Ym, Yp, Ysum,
-            output_prefix, N, q, p, citruss_path=TO_CITRUSS):
+            output_prefix, N, q, p, citruss_path=TO_CITRUSS, chunk_size=None,
+            profiler=profiling.DISABLED, dtype=None, check_precision=False,
+            screen=SCREEN):
     """
     Estimate the parameters of a model given the input data and 
     hyperparameters. Compute the BIC. 
 
-    Note: must give full name of file path. 
+    Note: must give full name of file path. If chunk_size is given, 
+    the data matrices may be memory-mapped (see load_rows) and are 
+    scored chunk_size individuals at a time. dtype sets the precision 
+    of the likelihood (see llik); with check_precision the BIC is also 
+    computed in float64 and the difference printed. screen is passed 
+    on to run_citruss.
     """
     # first, run citruss
-    run_citruss(fYsum, fYm, fYp, fXm, fXp, output_prefix,
-                regV, regF, regGamma, regPsi, N, q, p, citruss_path)
+    with profiler.phase("fit"):
+        run_citruss(fYsum, fYm, fYp, fXm, fXp, output_prefix,
+                    regV, regF, regGamma, regPsi, N, q, p, citruss_path,
+                    screen=screen)
 
-    # now, load the output data
-    Fmat = np.loadtxt(output_prefix + "F.txt")
-    Vmat = np.loadtxt(output_prefix + "V.txt")
-    GammaMat = np.loadtxt(output_prefix + "Gamma.txt")
-    PsiMat = np.loadtxt(output_prefix + "Psi.txt")
+    # now, load the output data (sparse)
+    with profiler.phase("load_params"):
+        Vmat, Fmat, GammaMat, PsiMat = sparse_params.load_params(output_prefix)
 
     # return the resulting BIC and log-likelihood
-    return (BIC(Xm, Xp, Ym, Yp, Ysum, Fmat, Vmat, GammaMat, PsiMat,
-                regF, regV, regGamma, regPsi),
-            llik(Xm, Xp, Ym, Yp, Ysum, Fmat, Vmat, GammaMat, PsiMat,
-                 regF, regV, regGamma, regPsi))
+    with profiler.phase("score"):
+        llik_val = llik(Xm, Xp, Ym, Yp, Ysum, Fmat, Vmat, GammaMat, PsiMat,
+                        regF, regV, regGamma, regPsi, chunk_size=chunk_size,
+                        dtype=dtype)
+        bic = BIC(Xm, Xp, Ym, Yp, Ysum, Fmat, Vmat, GammaMat, PsiMat,
+                  regF, regV, regGamma, regPsi, llik_val=llik_val)
+
+    if check_precision and dtype is not None and np.dtype(dtype) != np.float64:
+        with profiler.phase("check_precision"):
+            check_BIC_precision(Xm, Xp, Ym, Yp, Ysum, Fmat, Vmat, GammaMat,
+                                PsiMat, regF, regV, regGamma, regPsi,
+                                dtype=dtype, chunk_size=chunk_size,
+                                bic_low=bic[0])
+
+    return bic, llik_val
+
+
+def submit_BIC_grid(spool, fXm, fXp, fYm, fYp, fYsum,
+                    regV, regF, regGamma, regPsi, output_prefix,
+                    citruss_path=TO_CITRUSS, chunk_size=None, dtype=None,
+                    check_precision=False, screen=SCREEN):
+    """
+    Submit one get_BIC job per grid point to a work_queue spool directory. 
+    Each grid point writes its fit under output_prefix + "{i}_" so that 
+    workers on different nodes do not overwrite each other. chunk_size, 
+    dtype, check_precision and screen are passed on to get_BIC. Returns 
+    the list of job ids; results are read back with 
+    work_queue.collect_results.
+    """
+    N, p = matrix_cache.text_shape(fXm)
+    _, q = matrix_cache.text_shape(fYsum)
+    job_ids = []
+    for i in range(len(regV)):
+        args = {"fXm": fXm, "fXp": fXp, "fYm": fYm, "fYp": fYp, "fYsum": fYsum,
+                "regV": float(regV[i]), "regF": float(regF[i]),
+                "regGamma": float(regGamma[i]), "regPsi": float(regPsi[i]),
+                "output_prefix": output_prefix + "{}_".format(i),
+                "N": N, "q": q, "p": p, "citruss_path": citruss_path,
+                "chunk_size": chunk_size,
+                # job arguments are JSON, so the dtype goes by name
+                "dtype": None if dtype is None else np.dtype(dtype).name,
+                "check_precision": check_precision, "screen": screen}
+        job_ids.append(work_queue.submit(spool, "bic", args))
+    return job_ids
+
+
+def rescore_BIC_grid(Xm, Xp, Ym, Yp, Ysum, regV, regF, regGamma, regPsi,
+                     output_prefix, memory=SCORE_MEMORY, dtype=None):
+    """
+    Scores every fit of a submitted grid (under output_prefix + "{i}_", 
+    see submit_BIC_grid) in one batch with score_param_sets. Returns 
+    [((bic, k), llik), ...] in grid order, as get_BIC does per point.
+    """
+    param_sets = [sparse_params.load_params(output_prefix + "{}_".format(i))
+                  for i in range(len(regV))]
+    regs = list(zip(regF, regV, regGamma, regPsi))
+    bic, k, llik_val = score_param_sets(Xm, Xp, Ym, Yp, Ysum, param_sets,
+                                        regs, memory=memory, dtype=dtype)
+    return [((bic[i], k[i]), llik_val[i]) for i in range(len(regV))]
+
+
+# %% cross-validation
+def kfold_indices(N, K, seed=None):
+    """
+    Splits the individuals 0..N-1 into K random folds. The folds are 
+    views into a single permutation of the row indices; no data is copied.
+    """
+    perm = np.random.default_rng(seed).permutation(N)
+    return np.array_split(perm, K)
+
+
+def training_rows(folds, k):
+    """
+    Sorted row indices of every fold but fold k.
+    """
+    return np.sort(np.concatenate([f for j, f in enumerate(folds) if j != k]))
+
+
+def write_folds(Xm, Xp, Ym, Yp, Ysum, folds, output_prefix, chunk_size=1000,
+                dtype=np.float64):
+    """
+    Writes the training set of each fold for citruss, chunk_size rows at a 
+    time, under output_prefix + "fold{k}_". Returns one dict of file names 
+    (keys fXm, fXp, fYm, fYp, fYsum) per fold.
+    """
+    fmt = '%.9g' if np.dtype(dtype) == np.float32 else '%.18e'
+    fold_files = []
+    for k in range(len(folds)):
+        rows = training_rows(folds, k)
+        files = {}
+        for name, mat in (("Xm", Xm), ("Xp", Xp), ("Ym", Ym), ("Yp", Yp),
+                          ("Ysum", Ysum)):
+            fname = output_prefix + "fold{}_{}.txt".format(k, name)
+            with open(fname, "w") as f:
+                for start in range(0, len(rows), chunk_size):
+                    np.savetxt(f, mat[rows[start:start + chunk_size]], fmt=fmt)
+            files["f" + name] = fname
+        fold_files.append(files)
+    return fold_files
+
+
+def get_CV(fold_files, folds, regV, regF, regGamma, regPsi,
+           Xm, Xp, Ym, Yp, Ysum, output_prefix, q, p,
+           citruss_path=TO_CITRUSS, chunk_size=None, dtype=None, workers=None,
+           screen=SCREEN):
+    """
+    K-fold held-out likelihood for one hyperparameter setting, as an 
+    alternative to the in-sample BIC. The K citruss fits run in parallel 
+    (one thread each, K by default); each fold is then scored on its 
+    held-out rows with llik, without the penalty terms.
+    Inputs:
+        fold_files (list) - training files of each fold, from write_folds
+        folds (list) - held-out row indices of each fold, from kfold_indices
+    Outputs:
+        mean (float) - mean held-out negative log-likelihood per individual
+        se (float) - standard error of the mean over folds
+        per_fold (np.array) - held-out negative log-likelihood per 
+                              individual of each fold
+    """
+    def fit_and_score(k):
+        files = fold_files[k]
+        prefix = output_prefix + "fold{}_".format(k)
+        N_train = Xm.shape[0] - len(folds[k])
+        run_citruss(files["fYsum"], files["fYm"], files["fYp"], files["fXm"],
+                    files["fXp"], prefix, regV, regF, regGamma, regPsi,
+                    N_train, q, p, citruss_path, screen=screen)
+        Vmat, Fmat, GammaMat, PsiMat = sparse_params.load_params(prefix)
+        return llik(Xm, Xp, Ym, Yp, Ysum, Fmat, Vmat, GammaMat, PsiMat,
+                    0, 0, 0, 0, chunk_size=chunk_size, dtype=dtype,
+                    rows=folds[k]) / len(folds[k])
+
+    K = len(folds)
+    with ThreadPoolExecutor(max_workers=workers or K) as pool:
+        per_fold = np.array(list(pool.map(fit_and_score, range(K))))
+    return per_fold.mean(), per_fold.std(ddof=1) / np.sqrt(K), per_fold
 
 
 # %% Bayesian Information Criterion
 def BIC(Xm, Xp, Ym, Yp, Ysum, Fmat, Vmat, GammaMat, PsiMat, regF,
-        regV, regGamma, regPsi):
+        regV, regGamma, regPsi, chunk_size=None, dtype=None, llik_val=None):
     """
     Returns the Bayesian Information Criterion of the estimated 
     CGGM given the parameters used to estimate the model and the 
-    final estimate. 
+    final estimate. llik_val may be passed if llik was already computed 
+    with the same arguments.
     """
     nnzF = nnz(Fmat)
     nnzV = nnz(Vmat)
@@ -100,30 +360,194 @@ def BIC(Xm, Xp, Ym, Yp, Ysum, Fmat, Vmat, GammaMat, PsiMat, regF,
     k = nnzF + nnzV + nnzGamma + nnzPsi
     n = Xm.shape[0]
 
-    llik_val = llik(Xm, Xp, Ym, Yp, Ysum, Fmat, Vmat, GammaMat, PsiMat,
-                    regF, regV, regGamma, regPsi)
+    if llik_val is None:
+        llik_val = llik(Xm, Xp, Ym, Yp, Ysum, Fmat, Vmat, GammaMat, PsiMat,
+                        regF, regV, regGamma, regPsi, chunk_size=chunk_size,
+                        dtype=dtype)
 
     return (k * np.log(n) + 2 * llik_val, k)
 
 
+def check_BIC_precision(Xm, Xp, Ym, Yp, Ysum, Fmat, Vmat, GammaMat, PsiMat,
+                        regF, regV, regGamma, regPsi, dtype=np.float32,
+                        chunk_size=None, bic_low=None):
+    """
+    Scores the same fit in dtype and in float64 and reports the BIC 
+    difference. bic_low may be passed if the dtype BIC is already known. 
+    Returns (BIC in dtype, BIC in float64, absolute difference).
+    """
+    if bic_low is None:
+        bic_low, _ = BIC(Xm, Xp, Ym, Yp, Ysum, Fmat, Vmat, GammaMat, PsiMat,
+                         regF, regV, regGamma, regPsi, chunk_size=chunk_size,
+                         dtype=dtype)
+    bic_64, _ = BIC(Xm, Xp, Ym, Yp, Ysum, Fmat, Vmat, GammaMat, PsiMat,
+                    regF, regV, regGamma, regPsi, chunk_size=chunk_size,
+                    dtype=np.float64)
+    diff = abs(bic_low - bic_64)
+    print("BIC in {}: {}, in float64: {}, difference: {} ({:.2e} relative)".format(
+        np.dtype(dtype).name, bic_low, bic_64, diff, diff / abs(bic_64)))
+    return bic_low, bic_64, diff
+
+
+def score_param_sets(Xm, Xp, Ym, Yp, Ysum, param_sets, regs=None,
+                     memory=SCORE_MEMORY, dtype=None):
+    """
+    Scores many fitted models on the same data at once; the batched 
+    equivalent of calling BIC and llik per model. Xs, Xd, Ys and Yd are 
+    built once for all models (in memory, also for memory-mapped inputs). 
+    Models are then scored in groups: F and Psi of a group are stacked 
+    side by side so the products with the data are one matrix product per 
+    chunk of individuals, and the V solves and log-determinants are 
+    batched over the group (V is made dense for this). Group and chunk sizes keep the intermediate 
+    arrays within about memory bytes. dtype is used as in llik.
+    Inputs:
+        param_sets (list) - (V, F, Gamma, Psi) of each model, dense or 
+                            sparse, e.g. from sparse_params.load_params
+        regs (list) - (regF, regV, regGamma, regPsi) of each model for 
+                      the penalty terms of llik; no penalty if None
+    Outputs:
+        bic (np.array) - BIC of each model
+        k (np.array) - number of non-zero parameters of each model
+        llik_val (np.array) - NEGATIVE (penalised) log-likelihood of each model
+    """
+    m = len(param_sets)
+    n, p = Xm.shape
+    q = Ysum.shape[1]
+    if regs is None:
+        regs = [(0, 0, 0, 0)] * m
+
+    # data-side transforms, once for every model
+    Xs = np.asarray(Xm) + np.asarray(Xp)
+    Xd = np.asarray(Xm) - np.asarray(Xp)
+    Ys = np.asarray(Ysum)
+    Yd = np.asarray(Ym) - np.asarray(Yp)
+    fin = np.isfinite(Yd)
+    Yd = np.where(fin, Yd, 0)
+    if dtype is not None:
+        Xs, Xd, Ys, Yd = (A.astype(dtype, copy=False) for A in (Xs, Xd, Ys, Yd))
+    # c1 of both terms: q genes in the sum, the observed ones in the difference
+    const = 0.5 * (q + fin.sum(axis=1)) * np.log(2 * np.pi)
+
+    # V, F, Psi of a group; about six n x q arrays per model in a chunk
+    group = int(max(1, min(m, memory // (16 * (q * q + 2 * p * q)))))
+    chunk = int(max(1, min(n, memory // (48 * group * q))))
+
+    llik_sum = np.zeros(m)
+    for g0 in range(0, m, group):
+        models = param_sets[g0:g0 + group]
+        Vs = np.stack([np.asarray(sparse_params.to_dense(V), dtype=np.float64)
+                       for V, _, _, _ in models])
+        gam = np.stack([np.asarray(Gamma.diagonal())
+                        for _, _, Gamma, _ in models]).astype(np.float64)
+        Fcat = _hstack([F for _, F, _, _ in models], dtype)
+        Psicat = _hstack([Psi for _, _, _, Psi in models], dtype)
+        sign, logdetV = np.linalg.slogdet(Vs)
+        logdetV[sign <= 0] = np.nan
+        mb = len(models)
+
+        for start in range(0, n, chunk):
+            stop = min(start + chunk, n)
+            xs, xd, ys, yd, f = (A[start:stop] for A in (Xs, Xd, Ys, Yd, fin))
+            nc = stop - start
+
+            # sum model, (4a): one (n x q) block per model
+            XF = np.asarray(xs @ Fcat).reshape(nc, mb, q).transpose(1, 0, 2)
+            W = np.linalg.solve(Vs, XF.transpose(0, 2, 1))
+            c3 = -0.5 * np.einsum("knq,kqn->kn", XF, W)
+            yVy = np.sum((ys @ Vs) * ys, axis=2)
+            num = -0.5 * (yVy - np.sum(XF * ys, axis=2))
+            lsum = num - (-0.5 * logdetV[:, None] + c3)
+
+            # difference model, (4b), over the observed genes only
+            Z = np.asarray(xd @ Psicat).reshape(nc, mb, q).transpose(1, 0, 2)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                c2 = -0.5 * np.sum(np.where(f, np.log(gam)[:, None, :], 0), axis=2)
+                c3 = -0.5 * np.sum(np.where(f, Z * Z / gam[:, None, :], 0), axis=2)
+            num = -0.5 * ((yd * yd) @ gam.T).T + 0.5 * np.sum(Z * yd, axis=2)
+            ldiff = num - (c2 + c3)
+
+            llik_sum[g0:g0 + mb] += np.sum(lsum + ldiff - const[start:stop],
+                                           axis=1, dtype=np.float64)
+
+    k = np.array([nnz(F) + nnz(V) + nnz(Gamma) + nnz(Psi)
+                  for V, F, Gamma, Psi in param_sets])
+    penalty = np.array([regF * np.sum(np.abs(F)) + regV * np.sum(np.abs(V)) +
+                        regGamma * np.sum(np.abs(Gamma)) +
+                        regPsi * np.sum(np.abs(Psi))
+                        for (V, F, Gamma, Psi), (regF, regV, regGamma, regPsi)
+                        in zip(param_sets, regs)])
+    llik_val = -llik_sum + penalty
+    return k * np.log(n) + 2 * llik_val, k, llik_val
+
+
+def _hstack(mats, dtype=None):
+    """
+    Side-by-side stack of p x q matrices, sparse if any of them is.
+    """
+    if any(sp.issparse(A) for A in mats):
+        out = sp.hstack([sp.csr_matrix(A) for A in mats]).tocsr()
+    else:
+        out = np.hstack([np.asarray(A) for A in mats])
+    return out if dtype is None else out.astype(dtype, copy=False)
+
+
 # %% log-likelihood
 def llik(Xm, Xp, Ym, Yp, Ysum, Fmat, Vmat, GammaMat, PsiMat, regF,
-         regV, regGamma, regPsi):
+         regV, regGamma, regPsi, chunk_size=None, dtype=None, rows=None):
     """
     Returns the NEGATIVE log-likelihood of the model given its parameters.
+    If chunk_size is given, individuals are scored chunk_size rows at a 
+    time so that Xs, Xd and Yd are never built for the whole cohort.
+    Fmat and PsiMat may be scipy.sparse matrices; they are densified 
+    unless large and sparse enough (SPARSE_FP_DENSITY, SPARSE_FP_MIN_SIZE), 
+    else sparse-dense products are used. If dtype is given (e.g. np.float32), the data and 
+    F, Psi are cast to it for the products with the data; V and Gamma, 
+    hence the log-determinants, and the sum over individuals stay float64.
+    A scipy.sparse V (with density at most SPARSE_V_DENSITY) is factorised 
+    once with a sparse Cholesky/LU, which gives log det V and the V^-1 F^T x 
+    solves without forming the dense q x q inverse. If rows is given, only 
+    those individuals are scored, gathering chunk_size rows at a time.
     """
-    # get Xs, Xd
-    Xs = Xm + Xp
-    Xd = Xm - Xp
-
-    # get Ys, Yd
-    Ys = Ysum
-    Yd = Ym - Yp
-
-    def get_prob(i):
-        return individual_prob(Xs, Xd, Ys, Yd, Fmat, Vmat, GammaMat, PsiMat, i, log=True)
-
-    llik_arr = np.array([get_prob(i) for i in range(Xs.shape[0])])
+    # a sparse V is factorised once; a dense one is inverted per individual
+    Vfactor = None
+    if sp.issparse(Vmat) and \
+            Vmat.nnz <= SPARSE_V_DENSITY * Vmat.shape[0] * Vmat.shape[1]:
+        Vmat = sp.csr_matrix(Vmat, dtype=np.float64)
+        Vfactor = factor_precision(Vmat)
+    else:
+        Vmat = np.asarray(sparse_params.to_dense(Vmat), dtype=np.float64)
+    # Gamma is indexed on its diagonal below
+    GammaMat = np.asarray(sparse_params.to_dense(GammaMat), dtype=np.float64)
+    Fc, PsiC = keep_sparse_or_dense(Fmat), keep_sparse_or_dense(PsiMat)
+    if dtype is not None:
+        Fc = Fc.astype(dtype, copy=False)
+        PsiC = PsiC.astype(dtype, copy=False)
+
+    if rows is not None and chunk_size is None:
+        chunk_size = 1000
+
+    if chunk_size is None:
+        # get Xs, Xd
+        Xs = Xm + Xp
+        Xd = Xm - Xp
+
+        # get Ys, Yd
+        Ys = Ysum
+        Yd = Ym - Yp
+        if dtype is not None:
+            Xs, Xd, Ys, Yd = (A.astype(dtype, copy=False) for A in (Xs, Xd, Ys, Yd))
+
+        def get_prob(i):
+            return individual_prob(Xs, Xd, Ys, Yd, Fc, Vmat, GammaMat, PsiC, i, log=True,
+                                   Vfactor=Vfactor)
+
+        llik_arr = np.array([get_prob(i) for i in range(Xs.shape[0])],
+                            dtype=np.float64)
+    else:
+        llik_arr = llik_individuals_chunked(Xm, Xp, Ym, Yp, Ysum, Fc, Vmat,
+                                            GammaMat, PsiC, chunk_size,
+                                            dtype=dtype, Vfactor=Vfactor,
+                                            rows=rows)
 
     return -np.sum(llik_arr) + \
         regF * np.sum(np.abs(Fmat)) + \
@@ -132,21 +556,71 @@ def llik(Xm, Xp, Ym, Yp, Ysum, Fmat, Vmat, GammaMat, PsiMat, regF,
         regPsi * np.sum(np.abs(PsiMat))
 
 
+def keep_sparse_or_dense(A):
+    """
+    A as is if it is dense, or sparse with at least SPARSE_FP_MIN_SIZE 
+    entries of which at most SPARSE_FP_DENSITY are non-zero; otherwise 
+    a dense copy for the per-individual products of llik.
+    """
+    if not sp.issparse(A):
+        return A
+    size = A.shape[0] * A.shape[1]
+    if size >= SPARSE_FP_MIN_SIZE and A.nnz <= SPARSE_FP_DENSITY * size:
+        return sp.csr_matrix(A)
+    return sparse_params.to_dense(A)
+
+
+def llik_individuals_chunked(Xm, Xp, Ym, Yp, Ysum, Fmat, Vmat, GammaMat,
+                             PsiMat, chunk_size=1000, dtype=None,
+                             Vfactor=None, rows=None):
+    """
+    Returns the log-probability of each individual, reading the data 
+    matrices chunk_size rows at a time. The inputs may be np.memmap 
+    objects (see load_rows); only one chunk of each is resident at once. 
+    The per-individual terms are kept and summed at the end, so the 
+    result is identical to the in-memory path of llik. Each chunk is 
+    cast to dtype if given. Vfactor is passed on to prob_sum_individual. 
+    If rows is given, only those individuals are scored, in that order.
+    """
+    N = Xm.shape[0] if rows is None else len(rows)
+    llik_arr = np.empty(N)
+    for start in range(0, N, chunk_size):
+        stop = min(start + chunk_size, N)
+        idx = slice(start, stop) if rows is None else rows[start:stop]
+        xm = np.asarray(Xm[idx])
+        xp = np.asarray(Xp[idx])
+        Xs = xm + xp
+        Xd = xm - xp
+        Ys = np.asarray(Ysum[idx])
+        Yd = np.asarray(Ym[idx]) - np.asarray(Yp[idx])
+        if dtype is not None:
+            Xs, Xd, Ys, Yd = (A.astype(dtype, copy=False) for A in (Xs, Xd, Ys, Yd))
+        for i in range(stop - start):
+            llik_arr[start + i] = individual_prob(Xs, Xd, Ys, Yd, Fmat, Vmat,
+                                                  GammaMat, PsiMat, i, log=True,
+                                                  Vfactor=Vfactor)
+    return llik_arr
+
+
 # calculate the probability for each individual
-def individual_prob(Xs, Xd, Ys, Yd, Fmat, Vmat, GammaMat, PsiMat, i, log=False):
+def individual_prob(Xs, Xd, Ys, Yd, Fmat, Vmat, GammaMat, PsiMat, i, log=False,
+                    Vfactor=None):
     """
     Calculates the probability of the data given the parameters for a single 
-    individual i. 
+    individual i. Vfactor is an optional factorisation of Vmat from 
+    factor_precision.
     """
     ifin = np.isfinite(Yd[i])
     yd = Yd[i, ifin]
 
     if log:
-        return prob_sum_individual(Ys[i], Xs[i], Vmat, Fmat, log=True) + \
+        return prob_sum_individual(Ys[i], Xs[i], Vmat, Fmat, log=True,
+                                   Vfactor=Vfactor) + \
             prob_diff_individual(yd, Xd[i], np.diag(
                 GammaMat[ifin, ifin]), PsiMat[:, ifin], log=True)
     else:
-        return prob_sum_individual(Ys[i], Xs[i], Vmat, Fmat) * \
+        return prob_sum_individual(Ys[i], Xs[i], Vmat, Fmat,
+                                   Vfactor=Vfactor) * \
             prob_diff_individual(yd, Xd[i], np.diag(
                 GammaMat[ifin, ifin]), PsiMat[:, ifin])
 
@@ -175,13 +649,26 @@ def prob_diff_individual(Yd, Xd, Gamma, Psi, log=False):
         return np.exp(-0.5 * (Yd.T @ Gamma @ Yd - Xd.T @ Psi @ Yd)) / Z
 
 
-def prob_sum_individual(Ys, Xs, V, F, log=False):
+def prob_sum_individual(Ys, Xs, V, F, log=False, Vfactor=None):
     """
     Calculates equation (4a) from manuscript ASE_net.
+    If Vfactor = (log det V, solve) is given (see factor_precision), it is 
+    used instead of the dense determinant and inverse of V.
     """
     # number of genes
     q, _ = V.shape
 
+    if Vfactor is not None:
+        logdetV, solve = Vfactor
+        xF = Xs.T @ F
+        c1 = (q / 2) * np.log(2 * np.pi)
+        c2 = -0.5 * logdetV
+        c3 = -0.5 * (xF @ solve(xF))
+        num = -0.5 * (Ys.T @ (V @ Ys) - xF @ Ys)
+        if log:
+            return num - (c1 + c2 + c3)
+        return np.exp(num - (c1 + c2 + c3))
+
     if log:
         c1 = (q / 2) * np.log(2 * np.pi)
         c2 = -0.5 * np.log(np.linalg.det(V))
@@ -198,6 +685,57 @@ def prob_sum_individual(Ys, Xs, V, F, log=False):
         return np.exp(-0.5 * (Ys.T @ V @ Ys - Xs.T @ F @ Ys)) / Z
 
 
+def factor_precision(V):
+    """
+    Factorises a sparse precision matrix V once. Returns (log det V, solve), 
+    where solve(b) returns V^-1 b. Uses a sparse Cholesky (CHOLMOD) if 
+    scikit-sparse is installed, otherwise (or if V is not positive 
+    definite) a sparse LU (SuperLU). As on the dense path, log det V is 
+    nan if det V < 0 and -inf if V is singular, so an invalid fit never 
+    gets a finite score.
+    """
+    V = sp.csc_matrix(V, dtype=np.float64)
+    if cholmod_cholesky is not None:
+        try:
+            factor = cholmod_cholesky(V)
+            return factor.logdet(), factor
+        except CholmodNotPositiveDefiniteError:
+            pass
+    try:
+        lu = spla.splu(V)
+    except RuntimeError:
+        # exactly singular
+        return -np.inf, lambda b: np.full(np.shape(b), np.nan)
+    # Pr V Pc = L U with a unit diagonal L
+    diagU = lu.U.diagonal()
+    sign = _perm_sign(lu.perm_r) * _perm_sign(lu.perm_c) * \
+        np.prod(np.sign(diagU))
+    if sign == 0:
+        logdetV = -np.inf
+    elif sign < 0:
+        logdetV = np.nan
+    else:
+        logdetV = np.sum(np.log(np.abs(diagU)))
+    return logdetV, lambda b: lu.solve(np.asarray(b, dtype=np.float64))
+
+
+def _perm_sign(perm):
+    """
+    Sign (+1 or -1) of a permutation given as an index array.
+    """
+    seen = np.zeros(len(perm), dtype=bool)
+    transpositions = 0
+    for start in range(len(perm)):
+        length = 0
+        j = start
+        while not seen[j]:
+            seen[j] = True
+            j = perm[j]
+            length += 1
+        transpositions += max(length - 1, 0)
+    return -1 if transpositions % 2 else 1
+
+
 # %% grid search
 def hyper_grid(minF, maxF, minV, maxV, minGamma, maxGamma, minPsi, maxPsi,
                resolution=[10, 10, 10, 10]):
@@ -215,23 +753,71 @@ def hyper_grid(minF, maxF, minV, maxV, minGamma, maxGamma, minPsi, maxPsi,
 
 def nnz(matrix):
     """
-    Gets the number of non-zero entries in a matrix.
+    Gets the number of non-zero entries in a (dense or sparse) matrix.
+    """
+    return sparse_params.nnz(matrix)
+
+
+# %% out-of-core data access
+def text_to_npy(ftxt, fnpy=None, chunk_size=1000, dtype=np.float64):
+    """
+    Converts a whitespace-delimited text matrix to a .npy file without 
+    holding the whole matrix in memory. The text is read twice: once to 
+    get the shape, once to fill a memory-mapped output chunk_size rows 
+    at a time, stored as dtype. Returns the name of the .npy file (ftxt 
+    with its extension replaced by default).
+    """
+    if fnpy is None:
+        fnpy = os.path.splitext(ftxt)[0] + ".npy"
+
+    nrow, ncol = 0, None
+    with open(ftxt) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            if ncol is None:
+                ncol = len(line.split())
+            nrow += 1
+
+    out = np.lib.format.open_memmap(fnpy, mode='w+', dtype=dtype,
+                                    shape=(nrow, ncol))
+    with open(ftxt) as f:
+        lines = (line for line in f if line.strip())
+        start = 0
+        while start < nrow:
+            chunk = list(itertools.islice(lines, chunk_size))
+            out[start:start + len(chunk)] = np.loadtxt(chunk, ndmin=2)
+            start += len(chunk)
+    out.flush()
+    del out
+    return fnpy
+
+
+def load_rows(fname):
+    """
+    Opens a .npy matrix as a read-only memory map, so rows are only read 
+    from disk when a chunk of them is accessed.
     """
-    return len(np.nonzero(matrix)[0])
+    return np.load(fname, mmap_mode='r')
 
 
 # %% for running citruss.py
 def run_citruss(fysum, fym, fyp, fxm, fxp, output_prefix,
                 vreg, freg, gammareg, psireg, N, q, p,
-                citruss_path):
+                citruss_path, screen=SCREEN):
     """
     Run citruss on a dataset with the given parameters.
+    With screen, genes are fit in independent blocks where possible
+    (screening.fit_screened).
     """
     cmd_list = ['python', citruss_path, str(N), str(q), str(p),
                 fysum, fym, fyp, fxm, fxp, output_prefix,
                 str(vreg), str(freg), str(gammareg), str(psireg)]
 
-    subprocess.run(cmd_list, check=True)
+    if not (screen and screening.fit_screened(fysum, fym, fyp, fxm, fxp,
+                                              output_prefix, vreg, freg,
+                                              gammareg, psireg, citruss_path)):
+        subprocess.run(cmd_list, check=True)
 
 
 # %% execute main
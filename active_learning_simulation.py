@@ -3,9 +3,19 @@
 # active_learning_simulation.py 
 ############################################################
 
+import functools
 import sys 
 import numpy as np 
 import subprocess
+import scipy.sparse as sp
+
+import async_writer
+import cohort as cohort_layout
+import matrix_cache
+import profiling
+import screening
+import run_archive
+import sparse_params
 
 # for set cover algorithm 
 sys.path.append("/mnt/c/Users/apare/Desktop/KimResearchGroup/Spring2022/setCoverProblem/")
@@ -22,6 +32,36 @@ MAXITER = 100
 LTHRESH = 0.85
 GTHRESH = 0.85
 
+# write each round's snapshot from a background thread while citruss runs
+ASYNC_WRITES = True
+
+# per-phase time/memory report (and cProfile dumps per iteration if
+# PSTATS_DIR is set); off by default
+PROFILE = False
+PSTATS_DIR = None
+
+# precision of the cohort matrices held in memory and written for citruss;
+# np.float32 halves memory and the size of the text snapshots
+DTYPE = np.float64
+
+# refit policy (see RefitPolicy): refit only once REFIT_MIN_NEW people were
+# added and the sequenced set grew by REFIT_MIN_GROWTH since the last fit;
+# stop once the Xi/Pi support is unchanged for STABLE_ROUNDS fits
+REFIT_MIN_NEW = 0
+REFIT_MIN_GROWTH = 0.0
+STABLE_ROUNDS = None
+
+# also append every snapshot and fit to one run archive (run_archive.py,
+# run_archive.ARCHIVE_NAME next to the fits); the *_large text files are
+# then only written for iteration 0, the starting split the random arm
+# reads. Only one arm may append to the archive at a time, so the arms
+# must not run concurrently with the archive on.
+ARCHIVE = False
+
+# fit the genes in independent blocks, each with its own citruss run,
+# where the joint fit is block diagonal in V (see screening)
+SCREEN = False
+
 # directory names
 ACTIVE_LEARNING_DIR = "active_learning_sims"
 
@@ -50,7 +90,10 @@ def active_learning_sim(start_ysum, start_ym, start_yp, start_xm, start_xp,
                         maxiter=MAXITER, general_prefix=GENERAL_PREFIX, 
                         active_learning_dir=ACTIVE_LEARNING_DIR, 
                         to_citruss=TO_CITRUSS, to_data=TO_DATA, 
-                        threshold=THRESHOLD, prop=INIT_PROP):
+                        threshold=THRESHOLD, prop=INIT_PROP,
+                        async_writes=ASYNC_WRITES, profile=PROFILE,
+                        pstats_dir=PSTATS_DIR, dtype=DTYPE, refit_policy=None,
+                        archive=ARCHIVE, screen=SCREEN):
     """
     Run the active learning simulation. 
     Inputs:
@@ -66,41 +109,80 @@ def active_learning_sim(start_ysum, start_ym, start_yp, start_xm, start_xp,
         to_citruss (str) - path to citruss.py command 
         threshold (int) - minimum number of ASE needed for each gene
         prop (float) - initial proportion of observations sampled
+        async_writes (bool) - save snapshots from a background thread, so
+                              the *_large files are written during the fit
+        profile (bool) - record time and peak memory of each phase and
+                         print a summary at the end
+        pstats_dir (str) - with profile, save a cProfile dump per iteration
+        dtype (np.dtype) - precision of the cohort matrices
+        refit_policy (RefitPolicy) - when to rerun citruss; by default
+                                     RefitPolicy(REFIT_MIN_NEW, REFIT_MIN_GROWTH,
+                                     STABLE_ROUNDS)
+        archive (bool) - append snapshots and fits to the run archive
+        screen (bool) - fit V in independent gene blocks where the
+                        screening rule allows (see screening)
     Outputs:
         None - files saved to active_learning_dir
     """
-    initialize_dataset(active_learning_dir, '0', start_ysum, start_ym, start_yp,
-                       start_xm, start_xp, prop)
+    writer = async_writer.AsyncWriter(background=async_writes)
+    profiler = profiling.Profiler(enabled=profile, pstats_dir=pstats_dir)
+    if archive:
+        archive = run_archive.RunArchive(general_prefix + to_data + active_learning_dir +
+                                         "/" + run_archive.ARCHIVE_NAME, "a")
+    else:
+        archive = None
+    with profiler.phase("initialize_dataset"):
+        cohort = initialize_dataset(
+            active_learning_dir, '0', start_ysum, start_ym, start_yp,
+            start_xm, start_xp, prop, writer=writer, dtype=dtype,
+            archive=archive)
+        # ASE and heterozygosity counts of the sequenced set, kept up to date
+        # as people are added instead of rescanning the files every round
+        coverage = SequencedCoverage(*cohort.small[1:])
+
+    if refit_policy is None:
+        refit_policy = RefitPolicy(REFIT_MIN_NEW, REFIT_MIN_GROWTH, STABLE_ROUNDS)
 
     for iiter in range(maxiter):
+        profiler.next_iteration(iiter)
         fysum = general_prefix + to_data + active_learning_dir + "/{}Ysum_small.txt".format(iiter)
         fym = general_prefix + to_data  + active_learning_dir + "/{}Ym_small.txt".format(iiter)
         fyp = general_prefix + to_data  + active_learning_dir + "/{}Yp_small.txt".format(iiter)
         fxm = general_prefix + to_data  + active_learning_dir + "/{}Xm_small.txt".format(iiter)
         fxp = general_prefix + to_data  + active_learning_dir + "/{}Xp_small.txt".format(iiter)
 
-        run_citruss(fysum, fym, fyp, fxm, fxp,
-                    general_prefix + to_data + active_learning_dir + "/" + str(iiter),
-                    0.01, 0.01, 0.01, 0.01, to_citruss)
+        # otherwise keep using the last fit's Xi and Pi
+        if refit_policy.should_refit(coverage.n):
+            with profiler.phase("fit"):
+                # citruss reads the sequenced set from disk
+                writer.wait([fysum, fym, fyp, fxm, fxp])
+                run_citruss(fysum, fym, fyp, fxm, fxp,
+                            general_prefix + to_data + active_learning_dir + "/" + str(iiter),
+                            0.01, 0.01, 0.01, 0.01, to_citruss, screen=screen)
 
-    
-        V = np.loadtxt(general_prefix + to_data  + active_learning_dir + "/" + str(iiter) + "V.txt")
-        F = np.loadtxt(general_prefix + to_data  + active_learning_dir + "/" + str(iiter) + "F.txt")
-        Gamma = np.loadtxt(general_prefix + to_data + active_learning_dir + "/" + str(iiter) + "Gamma.txt")
-        Psi = np.loadtxt(general_prefix + to_data  + active_learning_dir + "/" + str(iiter) + "Psi.txt")
+            with profiler.phase("load_params"):
+                V, F, Gamma, Psi = sparse_params.load_params(
+                    general_prefix + to_data + active_learning_dir + "/" + str(iiter))
+                archive_fit(archive, iiter, V, F, Gamma, Psi)
+
+                Omega, Xi, Pi = get_params(V, F, Gamma, Psi)
 
-        Omega, Xi, Pi = get_params(V, F, Gamma, Psi)
+            if refit_policy.fitted(coverage.n, Xi, Pi):
+                print("Xi/Pi support unchanged for {} fits".format(
+                    refit_policy.stable_rounds), file=sys.stderr)
+                break
 
         # determine needed genes
         #ym = np.loadtxt(fym) 
         #yp = np.loadtxt(fyp)
-        needed_eQTLs = determine_needed_eqtls(Xi, Pi, np.loadtxt(fym), np.loadtxt(fyp), 
-                                              np.loadtxt(fxm), np.loadtxt(fxp), LTHRESH, GTHRESH)
+        with profiler.phase("needed_eqtls"):
+            needed_eQTLs = determine_needed_eqtls(Xi, Pi, None, None, None, None,
+                                                  LTHRESH, GTHRESH, coverage=coverage)
 
         # determine if we even need to do another sampling 
         if len(needed_eQTLs) < 1:
             print("All genes have been sampled", file=sys.stderr)
-            return 
+            break
 
         # find people heterozygous for these traits in the remaining samples 
         fysum_large = general_prefix + to_data + active_learning_dir + "/" + str(iiter) + "Ysum_large.txt"
@@ -118,57 +200,173 @@ def active_learning_sim(start_ysum, start_ym, start_yp, start_xm, start_xp,
         #ym_large = np.loadtxt(fym_large)
         #yp_large = np.loadtxt(fyp_large)
 
-        people_array, people_sets = to_set_cover(np.loadtxt(fxm_large), np.loadtxt(fxp_large),
-                                                 np.loadtxt(fym_large), np.loadtxt(fyp_large), 
-                                                 needed_eQTLs)
+        with profiler.phase("set_cover"):
+            # the pool in memory holds the same rows as the *_large files
+            _, ym_large, yp_large, xm_large, xp_large = cohort.large
+            people_array, people_sets = to_set_cover(xm_large, xp_large,
+                                                     ym_large, yp_large,
+                                                     needed_eQTLs)
 
-        _, new_people = set_cover_greedy.set_cover_greedy(people_sets, needed_eQTLs)
-        new_people = [people_array[j] for j in new_people]
+            _, new_people = set_cover_greedy.set_cover_greedy(people_sets, needed_eQTLs)
+            new_people = [people_array[j] for j in new_people]
 
         print("{} new people".format(len(new_people)), file=sys.stderr)
 
         # simulation is over if mno new people. 
         if len(new_people) < 1:
-            return 
-
-        update_dataset(active_learning_dir, str(iiter+1), fysum_large, fysum_small, fym_large, fym_small, 
-                       fyp_large, fyp_small, fxm_large, fxm_small, fxp_large, fxp_small,
-                       new_people)
-
-    fysum = general_prefix + to_data + active_learning_dir + "/{}Ysum_small.txt".format(maxiter)
-    fym = general_prefix + to_data + active_learning_dir + "/{}Ym_small.txt".format(maxiter)
-    fyp = general_prefix + to_data + active_learning_dir + "/{}Yp_small.txt".format(maxiter)
-    fxm = general_prefix + to_data + active_learning_dir + "/{}Xm_small.txt".format(maxiter)
-    fxp = general_prefix + to_data + active_learning_dir + "/{}Xp_small.txt".format(maxiter)
-    run_citruss(fysum, fym, fyp, fxm, fxp,
-                general_prefix + to_data + active_learning_dir + "/" + str(maxiter),
-                0.01, 0.01, 0.01, 0.01, to_citruss)
+            break
+
+        with profiler.phase("update_dataset"):
+            # checkpoint: the pool rows are reordered in place, so this
+            # round's snapshots (the pool's written in the background
+            # during the fit) must be on stable storage first
+            writer.flush()
+            _, ym_new, yp_new, xm_new, xp_new = update_dataset(
+                active_learning_dir, str(iiter+1), cohort, new_people,
+                writer=writer, dtype=dtype, archive=archive)
+            coverage.add(ym_new, yp_new, xm_new, xp_new)
+    else:
+        iiter = maxiter
+
+    # final fit, only if people were added since the last one
+    if refit_policy.stale(coverage.n):
+        profiler.next_iteration(iiter)
+        fysum = general_prefix + to_data + active_learning_dir + "/{}Ysum_small.txt".format(iiter)
+        fym = general_prefix + to_data + active_learning_dir + "/{}Ym_small.txt".format(iiter)
+        fyp = general_prefix + to_data + active_learning_dir + "/{}Yp_small.txt".format(iiter)
+        fxm = general_prefix + to_data + active_learning_dir + "/{}Xm_small.txt".format(iiter)
+        fxp = general_prefix + to_data + active_learning_dir + "/{}Xp_small.txt".format(iiter)
+        with profiler.phase("fit"):
+            writer.wait([fysum, fym, fyp, fxm, fxp])
+            run_citruss(fysum, fym, fyp, fxm, fxp,
+                        general_prefix + to_data + active_learning_dir + "/" + str(iiter),
+                        0.01, 0.01, 0.01, 0.01, to_citruss, screen=screen)
+        refit_policy.fitted(coverage.n)
+        if archive is not None:
+            archive_fit(archive, iiter, *sparse_params.load_params(
+                general_prefix + to_data + active_learning_dir + "/" + str(iiter)))
+
+    writer.close()
+    if archive is not None:
+        archive.close()
+    refit_policy.report()
+    matrix_cache.report()
+    profiler.report()
 
 #---------------------------------------------------------------------
 # Run citruss.py on a dataset; reconstruct parameters 
 #---------------------------------------------------------------------
+class RefitPolicy:
+    """
+    Decides in which rounds active_learning_sim reruns citruss. 
+    Inputs:
+        min_new_people (int) - refit only once at least this many people 
+                               were added since the last fit
+        min_growth (float) - refit only once the sequenced set grew by at 
+                             least this fraction since the last fit
+        stable_rounds (int) - stop the simulation once the Xi/Pi support 
+                              is unchanged for this many consecutive fits
+                              (None never stops)
+    The first round is always fit. The defaults refit every round.
+    """
+
+    def __init__(self, min_new_people=0, min_growth=0.0, stable_rounds=None):
+        self.min_new_people = min_new_people
+        self.min_growth = min_growth
+        self.stable_rounds = stable_rounds
+        self.n_fit = None
+        self.fits_run = 0
+        self.fits_skipped = 0
+        self._support = None
+        self._unchanged = 0
+
+    def stale(self, n):
+        """
+        True if the sequenced set (n people) changed since the last fit; 
+        for the final fit. A final fit found unnecessary counts as skipped.
+        """
+        if self.n_fit != n:
+            return True
+        self.fits_skipped += 1
+        return False
+
+    def should_refit(self, n):
+        """
+        Whether to fit with n people sequenced; counts skipped fits.
+        """
+        if self.n_fit is None:
+            return True
+        added = n - self.n_fit
+        if added > 0 and added >= self.min_new_people and \
+                added >= self.min_growth * self.n_fit:
+            return True
+        self.fits_skipped += 1
+        return False
+
+    def fitted(self, n, Xi=None, Pi=None):
+        """
+        Record a fit with n people. Returns True if the Xi/Pi support has 
+        now been unchanged for stable_rounds consecutive fits.
+        """
+        self.n_fit = n
+        self.fits_run += 1
+        if Xi is None or self.stable_rounds is None:
+            return False
+        support = (frozenset(zip(*sparse_params.support(Xi))),
+                   frozenset(zip(*sparse_params.support(Pi))))
+        self._unchanged = self._unchanged + 1 if support == self._support else 0
+        self._support = support
+        return self._unchanged >= self.stable_rounds
+
+    def report(self, file=sys.stderr):
+        print("{} citruss fits run, {} saved by the refit policy".format(
+            self.fits_run, self.fits_skipped), file=file)
+
+
 def run_citruss(fysum, fym, fyp, fxm, fxp, output_prefix, 
-                vreg, freg, gammareg, psireg, citruss_path):
+                vreg, freg, gammareg, psireg, citruss_path, screen=SCREEN):
     """
     Run citruss on a dataset with the given parameters. 
+    With screen, genes are fit in independent blocks where possible
+    (screening.fit_screened).
     """
     # get N, q, p 
-    N, q = np.loadtxt(fysum).shape 
-    _, p = np.loadtxt(fxm).shape
+    N, q = matrix_cache.text_shape(fysum) 
+    _, p = matrix_cache.text_shape(fxm)
     
     cmd_list = ['python', citruss_path, str(N), str(q), str(p), 
                 fysum, fym, fyp, fxm, fxp, output_prefix, 
                 str(vreg), str(freg), str(gammareg), str(psireg)]
     
-    subprocess.run(cmd_list, check=True)
+    if not (screen and screening.fit_screened(fysum, fym, fyp, fxm, fxp,
+                                              output_prefix, vreg, freg,
+                                              gammareg, psireg, citruss_path)):
+        subprocess.run(cmd_list, check=True)
+
+
+def archive_fit(archive, iteration, V, F, Gamma, Psi):
+    """
+    Append a fit's parameters to the run archive (if any).
+    """
+    if archive is None:
+        return
+    for name, mat in zip(sparse_params.PARAM_NAMES, (V, F, Gamma, Psi)):
+        archive.put(iteration, "active", name, mat)
 
 
 def get_params(V, F, Gamma, Psi):
     """
     Reconstruct Omega, Xi, and Pi from the input parameters. 
+    Dense F is modified in place (Xi is F); sparse inputs give sparse 
+    outputs and F is left untouched.
     """
     Omega = V - Gamma 
     Pi = 2 * Psi 
+    if sp.issparse(F):
+        Xi = F.tocsr(copy=True)
+        Xi = Xi - Xi.multiply(Pi != 0)
+        Xi.eliminate_zeros()
+        return Omega, Xi, Pi
     Xi = F 
     Xi[np.nonzero(Pi)] = 0 
     return Omega, Xi, Pi
@@ -177,75 +375,32 @@ def get_params(V, F, Gamma, Psi):
 #---------------------------------------------------------------------
 # Initialize active learning dataset, update dataset after round
 #---------------------------------------------------------------------
-def update_dataset(outdir, outprefix, 
-                   fysum_large, fysum_small, 
-                   fym_large, fym_small, 
-                   fyp_large, fyp_small, 
-                   fxm_large, fxm_small,
-                   fxp_large, fxp_small,
-                   set_cover_people):
+def update_dataset(outdir, outprefix, cohort, set_cover_people,
+                   writer=None, dtype=np.float64, archive=None):
     """
     Adds people from set cover to new dataset of RNA-sequenced people.
     Removes people from set cover of non-RNA-sequences people. 
     Inputs:
         outdir (str) - the folder in which to save the initialized dataset.
         outprefix (str) - the prefix to give the saved files
-        fysum_large (str) - the name of the file containing old Ysum_large
-        fysum_small (str) - the name of the file containing old Ysum_small
-        fym_large (str) - the name of the file containing old Ym_large
-        fym_small (str) - the name of the file containing old Ym_small
-        fyp_large (str) - the name of the file containing old Yp_large
-        fyp_small (str) - the name of the file containingm old Yp_small
-        fxm_large (str) - the name of the file containing old Xm_large
-        fxm_small (str) - the name of the file containing old Xm_small
-        fxp_large (str) - the name of the file containing old Xp_large
-        fxp_small (str) - the name of the file containing old Xp_small
-        set_cover_people (np.array) - people to be sequenced
-    Outputs - none (saves files to outdir)
+        cohort (Cohort) - the sequenced set and pool, updated in place
+        set_cover_people (np.array) - people to be sequenced, as rows of 
+                                      the pool (the *_large files)
+        writer (AsyncWriter) - if given, files are queued on it instead of
+                               being written before returning
+        dtype (np.dtype) - precision the matrices are saved in
+        archive (RunArchive) - if given, the snapshot is also appended to it
+    Outputs - the rows added to the sequenced set, 
+              (ysum_new, ym_new, yp_new, xm_new, xp_new) (saves files to outdir)
     """
-    ysum_large = np.loadtxt(fysum_large)
-    ysum_small = np.loadtxt(fysum_small)
-    ym_large = np.loadtxt(fym_large) 
-    ym_small = np.loadtxt(fym_small) 
-    yp_large = np.loadtxt(fyp_large)
-    yp_small = np.loadtxt(fyp_small)
-    xm_large = np.loadtxt(fxm_large) 
-    xm_small = np.loadtxt(fxm_small) 
-    xp_large = np.loadtxt(fxp_large) 
-    xp_small = np.loadtxt(fxp_small) 
-
-    Nr, q = ysum_large.shape
-    _, p = xp_large.shape
-
-    mask = np.zeros(Nr, dtype=bool)
-    mask[set_cover_people] = 1
-
-    ysum_small = np.vstack((ysum_small, ysum_large[mask, :]))
-    ym_small = np.vstack((ym_small, ym_large[mask, :]))
-    yp_small = np.vstack((yp_small, yp_large[mask, :]))
-    xm_small = np.vstack((xm_small, xm_large[mask, :]))
-    xp_small = np.vstack((xp_small, xp_large[mask, :]))
-
-    ysum_large = ysum_large[np.logical_not(mask), :]
-    ym_large = ym_large[np.logical_not(mask), :]
-    yp_large = yp_large[np.logical_not(mask), :]
-    xm_large = xm_large[np.logical_not(mask), :]
-    xp_large = xp_large[np.logical_not(mask), :]
-
-    np.savetxt(file_path(outdir, outprefix, "Ysum_small.txt"), ysum_small)
-    np.savetxt(file_path(outdir, outprefix, "Ym_small.txt"), ym_small)
-    np.savetxt(file_path(outdir, outprefix, "Yp_small.txt"), yp_small)
-    np.savetxt(file_path(outdir, outprefix, "Xm_small.txt"), xm_small)
-    np.savetxt(file_path(outdir, outprefix, "Xp_small.txt"), xp_small)
-
-    np.savetxt(file_path(outdir, outprefix, "Ysum_large.txt"), ysum_large)
-    np.savetxt(file_path(outdir, outprefix, "Ym_large.txt"), ym_large)
-    np.savetxt(file_path(outdir, outprefix, "Yp_large.txt"), yp_large)
-    np.savetxt(file_path(outdir, outprefix, "Xm_large.txt"), xm_large)
-    np.savetxt(file_path(outdir, outprefix, "Xp_large.txt"), xp_large)
-
-
-def initialize_dataset(outdir, outprefix, fysum, fym, fyp, fxm, fxp, prop):
+    new_rows = cohort.sequence(set_cover_people)
+    save_dataset(outdir, outprefix, cohort, writer=writer, dtype=dtype,
+                 archive=archive)
+    return new_rows
+
+
+def initialize_dataset(outdir, outprefix, fysum, fym, fyp, fxm, fxp, prop,
+                       writer=None, dtype=np.float64, archive=None):
     """
     Initialize a dataset for an active learning simulation. 
     Inputs:
@@ -257,36 +412,78 @@ def initialize_dataset(outdir, outprefix, fysum, fym, fyp, fxm, fxp, prop):
         fxm (str) - the name of the file containing Xm
         fxp (str) - the name of the file containing Xp
         prop (float) - proportion of people to sample
-    Outputs - none (saves files to outdir)
+        writer (AsyncWriter) - if given, files are queued on it instead of
+                               being written before returning
+        dtype (np.dtype) - precision the matrices are loaded and saved in
+        archive (RunArchive) - if given, the snapshot is also appended to it
+    Outputs - the cohort (Cohort) with the sampled people sequenced 
+              (saves files to outdir)
     """
-    ysum = np.loadtxt(fysum)
-    ym = np.loadtxt(fym) 
-    yp = np.loadtxt(fyp)
-    xm = np.loadtxt(fxm) 
-    xp = np.loadtxt(fxp) 
-    
-    subset, remaining = random_subset_data(ysum, ym, yp, xm, xp, prop) 
+    cohort = cohort_layout.Cohort(np.loadtxt(fysum, dtype=dtype),
+                                  np.loadtxt(fym, dtype=dtype),
+                                  np.loadtxt(fyp, dtype=dtype),
+                                  np.loadtxt(fxm, dtype=dtype),
+                                  np.loadtxt(fxp, dtype=dtype), copy=False)
+
+    # same sample as random_subset_data
+    nsample = np.int64(cohort.N * prop)
+    cohort.sequence(np.random.choice(np.arange(0, cohort.N, 1, dtype=np.int64),
+                                     nsample, replace=False))
+
+    save_dataset(outdir, outprefix, cohort, writer=writer, dtype=dtype,
+                 archive=archive)
+    return cohort
+
+
+def save_dataset(outdir, outprefix, cohort, writer=None, dtype=np.float64,
+                 archive=None):
+    """
+    Saves the sequenced set and the pool of a cohort as the *_small and 
+    *_large files. With an archive, both are appended to it as well and 
+    only the *_small files (citruss' input) are written as text, plus 
+    the *_large files of iteration 0, which the random arm starts from 
+    whether or not it uses the archive.
+    """
+    savetxt = functools.partial(matrix_cache.savetxt if writer is None else writer.savetxt,
+                                fmt=text_fmt(dtype))
+
+    ysum_small, ym_small, yp_small, xm_small, xp_small = cohort.small
+    ysum_large, ym_large, yp_large, xm_large, xp_large = cohort.large
 
-    ysum_small, ym_small, yp_small, xm_small, xp_small = subset 
-    ysum_large, ym_large, yp_large, xm_large, xp_large = remaining 
+    savetxt(file_path(outdir, outprefix, "Ysum_small.txt"), ysum_small)
+    savetxt(file_path(outdir, outprefix, "Ym_small.txt"), ym_small)
+    savetxt(file_path(outdir, outprefix, "Yp_small.txt"), yp_small)
+    savetxt(file_path(outdir, outprefix, "Xm_small.txt"), xm_small)
+    savetxt(file_path(outdir, outprefix, "Xp_small.txt"), xp_small)
 
-    np.savetxt(file_path(outdir, outprefix, "Ysum_small.txt"), ysum_small)
-    np.savetxt(file_path(outdir, outprefix, "Ym_small.txt"), ym_small)
-    np.savetxt(file_path(outdir, outprefix, "Yp_small.txt"), yp_small)
-    np.savetxt(file_path(outdir, outprefix, "Xm_small.txt"), xm_small)
-    np.savetxt(file_path(outdir, outprefix, "Xp_small.txt"), xp_small)
+    if archive is not None:
+        for kind, small, large in zip(("Ysum", "Ym", "Yp", "Xm", "Xp"),
+                                      cohort.small, cohort.large):
+            archive.put(int(outprefix), "active", kind + "_small", small)
+            archive.put(int(outprefix), "active", kind + "_large", large)
+        if int(outprefix) != 0:
+            return
 
-    np.savetxt(file_path(outdir, outprefix, "Ysum_large.txt"), ysum_large)
-    np.savetxt(file_path(outdir, outprefix, "Ym_large.txt"), ym_large)
-    np.savetxt(file_path(outdir, outprefix, "Yp_large.txt"), yp_large)
-    np.savetxt(file_path(outdir, outprefix, "Xm_large.txt"), xm_large)
-    np.savetxt(file_path(outdir, outprefix, "Xp_large.txt"), xp_large)
+    savetxt(file_path(outdir, outprefix, "Ysum_large.txt"), ysum_large)
+    savetxt(file_path(outdir, outprefix, "Ym_large.txt"), ym_large)
+    savetxt(file_path(outdir, outprefix, "Yp_large.txt"), yp_large)
+    savetxt(file_path(outdir, outprefix, "Xm_large.txt"), xm_large)
+    savetxt(file_path(outdir, outprefix, "Xp_large.txt"), xp_large)
 
 
 def file_path(outdir, outprefix, fname):
     return ''.join((outdir, '/', outprefix, fname))
 
 
+def text_fmt(dtype):
+    """
+    np.savetxt format that round-trips values of the given precision.
+    """
+    if np.dtype(dtype) == np.float32:
+        return '%.9g'
+    return '%.18e'
+
+
 #---------------------------------------------------------------------
 # Taking subsets of the people and determining needed genes, set cover
 #---------------------------------------------------------------------
@@ -334,17 +531,30 @@ def random_subset_data(ysum, ym, yp, xm, xp, prop):
 
 
 # will need to change!
-def determine_needed_eqtls(xi, pi, ym, yp, xm, xp, Lthresh, Gthresh):
+def determine_needed_eqtls(xi, pi, ym, yp, xm, xp, Lthresh, Gthresh,
+                           coverage=None):
     """
     Determines the needed eQTLs, which happens when we do not have enough 
     people who are heterozygous at both the SNP and the expressed gene.
+    If coverage (SequencedCoverage) is given, its counters are used and 
+    ym, yp, xm, xp are ignored (may be None).
     """
+    if coverage is not None:
+        pct_ase = coverage.percentage_ase()
+        pct_het = coverage.percentage_heterozygotes()
+        needed_eqtls = set()
+        for params in (pi, xi):
+            x, y = sparse_params.support(params)
+            needed = (pct_ase[y] < Gthresh) | (pct_het[x] < Lthresh)
+            needed_eqtls.update(zip(x[needed], y[needed]))
+        return list(needed_eqtls)
+
     needed_eqtls = []
     N, q = ym.shape
     _, p = xm.shape
 
     # check cis eqtls
-    x, y = np.nonzero(pi)
+    x, y = sparse_params.support(pi)
     for i, j in zip(x, y):
         print(determine_percentage_ase(ym, yp, j), file=sys.stderr)
         if determine_percentage_ase(ym, yp, j) < Gthresh:
@@ -353,7 +563,7 @@ def determine_needed_eqtls(xi, pi, ym, yp, xm, xp, Lthresh, Gthresh):
             needed_eqtls.append((i, j))
 
     # check trans eqtls
-    x, y = np.nonzero(xi)
+    x, y = sparse_params.support(xi)
     for i, j in zip(x, y):
         print(determine_percentage_ase(ym, yp, j), file=sys.stderr)
         if determine_percentage_ase(ym, yp, j) < Gthresh:
@@ -385,6 +595,44 @@ def determine_percentage_heterozygotes_at_locus(Xm, Xp, loc):
     return np.mean(Xm[:, loc] != Xp[:, loc])
 
 
+class SequencedCoverage:
+    """
+    Counters over the RNA-sequenced set: the number of people with ASE 
+    available for each gene and the number heterozygous at each SNP. 
+    add() updates them in O(batch * (p + q)) when people are sequenced, so 
+    the needed-eQTL check does not rescan the whole sequenced set.
+    """
+
+    def __init__(self, ym, yp, xm, xp):
+        self.n = 0
+        self.ase_counts = np.zeros(ym.shape[1], dtype=np.int64)
+        self.het_counts = np.zeros(xm.shape[1], dtype=np.int64)
+        self.add(ym, yp, xm, xp)
+
+    def add(self, ym, yp, xm, xp):
+        """
+        Count newly sequenced people (rows of ym, yp, xm, xp).
+        """
+        ase = np.isfinite(ym)
+        assert np.array_equal(ase, np.isfinite(yp)),\
+                "Error: maternal and paternal matrices must have the same ASE availability."
+        self.ase_counts += ase.sum(axis=0)
+        self.het_counts += (xm != xp).sum(axis=0)
+        self.n += ym.shape[0]
+
+    def percentage_ase(self):
+        """
+        Fraction of the sequenced set with ASE available, per gene.
+        """
+        return self.ase_counts / self.n
+
+    def percentage_heterozygotes(self):
+        """
+        Fraction of the sequenced set heterozygous, per SNP.
+        """
+        return self.het_counts / self.n
+
+
 # will need to change!
 def to_set_cover(xm, xp, ym, yp, eqtls_needed):
     """
@@ -0,0 +1,134 @@
+######################################################################
+# async_writer.py
+# Background writer for simulation snapshots, so that saving the next
+# round's matrices overlaps with the citruss fit.
+######################################################################
+
+import atexit
+import os
+import queue
+import threading
+import numpy as np
+
+import matrix_cache
+
+
+class AsyncWriter:
+    """
+    Writes matrices to text files from a background thread.
+
+    savetxt() returns as soon as the array is queued; the queue is bounded
+    by maxsize so at most that many snapshots are held in memory waiting
+    to be written. Files are written to a temporary name and renamed into
+    place, so readers never see a partial file, and their parses are
+    dropped from matrix_cache. Use wait() on the files a step is about to
+    read, and flush() at checkpoint boundaries; close() is also registered
+    to run at process exit.
+
+    The caller must not modify an array after handing it to savetxt().
+    With background=False every write happens immediately in the caller.
+    """
+
+    def __init__(self, maxsize=10, background=True):
+        self.background = background
+        self._queue = queue.Queue(maxsize)
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._unsynced = []
+        self._errors = []
+        self._closed = False
+        self._thread = None
+        if background:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        atexit.register(self.close)
+
+    def savetxt(self, fname, array, **kwargs):
+        """
+        Queue array to be written to fname with np.savetxt(**kwargs).
+        """
+        fname = os.path.abspath(fname)
+        # the file is about to change; no reader may reuse the old parse
+        matrix_cache.invalidate(fname)
+        if not self.background:
+            self._write(fname, array, kwargs)
+            return
+        with self._lock:
+            done = self._pending.get(fname)
+            if done is None or done.is_set():
+                done = threading.Event()
+                self._pending[fname] = done
+        self._queue.put((fname, array, kwargs, done))
+
+    def wait(self, fnames):
+        """
+        Block until every file in fnames that has been queued is on disk.
+        Files that were never queued are ignored.
+        """
+        for fname in fnames:
+            with self._lock:
+                done = self._pending.get(os.path.abspath(fname))
+            if done is not None:
+                done.wait()
+        self._raise_errors()
+
+    def flush(self, fsync=True):
+        """
+        Barrier: block until the queue is drained and, if fsync is set,
+        until every file written since the last barrier is on stable storage.
+        """
+        if self.background:
+            self._queue.join()
+        if fsync:
+            with self._lock:
+                unsynced, self._unsynced = self._unsynced, []
+            for fname in unsynced:
+                fd = os.open(fname, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+        self._raise_errors()
+
+    def close(self):
+        """
+        Flush all pending writes with fsync and stop the background thread.
+        """
+        if self._closed:
+            return
+        self.flush(fsync=True)
+        self._closed = True
+        if self.background:
+            self._queue.put(None)
+            self._thread.join()
+        atexit.unregister(self.close)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                return
+            fname, array, kwargs, done = item
+            try:
+                self._write(fname, array, kwargs)
+            except Exception as err:
+                with self._lock:
+                    self._errors.append(err)
+            finally:
+                done.set()
+                self._queue.task_done()
+
+    def _write(self, fname, array, kwargs):
+        tmp = fname + ".tmp"
+        np.savetxt(tmp, array, **kwargs)
+        os.replace(tmp, fname)
+        matrix_cache.invalidate(fname)
+        with self._lock:
+            self._unsynced.append(fname)
+
+    def _raise_errors(self):
+        with self._lock:
+            errors, self._errors = self._errors, []
+        if errors:
+            raise errors[0]
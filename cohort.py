@@ -0,0 +1,93 @@
+######################################################################
+# cohort.py
+# In-memory layout of a simulation cohort: the five data matrices in
+# one row order, with the sequenced people as a prefix, so that the
+# small (sequenced) and large (pool) sets are views, not copies.
+######################################################################
+
+import numpy as np
+
+NAMES = ("ysum", "ym", "yp", "xm", "xp")
+
+
+class Cohort:
+    """
+    Holds ysum, ym, yp, xm and xp (N rows each, one row per person) in a
+    shared row order. Rows [0, n_seq) are the sequenced people ("small")
+    and rows [n_seq, N) the pool ("large"); small and large are slices.
+    ids[r] is the original row (person ID) of row r.
+
+    sequence() moves pool people into the sequenced set by swapping rows
+    and moving the boundary, so a round costs O(batch) instead of the
+    O(N) mask-and-vstack of building the sets from scratch. The newly
+    sequenced people are appended in ascending pool order, as with the
+    mask; the pool itself is reordered by the swaps.
+
+    Views handed out (small, large, and the AsyncWriter snapshots made
+    from them) stay valid for the sequenced rows, which never move again.
+    Pool rows change at the next sequence(), so snapshots of the pool must
+    be written before then.
+    """
+
+    def __init__(self, ysum, ym, yp, xm, xp, n_seq=0, ids=None, copy=True):
+        self.arrays = [np.array(A, copy=copy) for A in (ysum, ym, yp, xm, xp)]
+        self.N = self.arrays[0].shape[0]
+        if any(A.shape[0] != self.N for A in self.arrays):
+            raise ValueError("cohort matrices must have the same number of rows")
+        self.ids = np.arange(self.N) if ids is None else np.array(ids)
+        self.n_seq = n_seq
+
+    @classmethod
+    def from_parts(cls, small, large):
+        """
+        Cohort from an already split (small, large) pair of five-tuples;
+        the rows are copied once.
+        """
+        arrays = [np.vstack((s, l)) for s, l in zip(small, large)]
+        return cls(*arrays, n_seq=small[0].shape[0], copy=False)
+
+    @property
+    def small(self):
+        """
+        (ysum, ym, yp, xm, xp) of the sequenced people.
+        """
+        return tuple(A[:self.n_seq] for A in self.arrays)
+
+    @property
+    def large(self):
+        """
+        (ysum, ym, yp, xm, xp) of the pool.
+        """
+        return tuple(A[self.n_seq:] for A in self.arrays)
+
+    @property
+    def small_ids(self):
+        return self.ids[:self.n_seq]
+
+    @property
+    def large_ids(self):
+        return self.ids[self.n_seq:]
+
+    def sequence(self, idx):
+        """
+        Move the pool people at positions idx of the pool (indices into
+        large, e.g. from set cover) to the end of the sequenced set.
+        Returns their rows, (ysum, ym, yp, xm, xp), as views.
+        """
+        idx = np.unique(np.asarray(idx, dtype=np.int64))
+        if len(idx) and (idx[0] < 0 or idx[-1] >= self.N - self.n_seq):
+            raise IndexError("pool index out of range")
+        b = self.n_seq
+        # swap pool row b+k with b+idx[k], k ascending; since idx[k] >= k
+        # the row at b+idx[k] has not been moved yet when it is swapped
+        perm = {}
+        for k, s in enumerate(idx):
+            dst, src = b + k, b + int(s)
+            perm[dst], perm[src] = perm.get(src, src), perm.get(dst, dst)
+        if perm:
+            rows = np.fromiter(perm.keys(), dtype=np.int64, count=len(perm))
+            sources = np.fromiter(perm.values(), dtype=np.int64, count=len(perm))
+            for A in self.arrays + [self.ids]:
+                A[rows] = A[sources]
+        self.n_seq = b + len(idx)
+        return tuple(A[b:self.n_seq] for A in self.arrays)
@@ -0,0 +1,672 @@
+######################################################################
+# equivalence_harness.py
+# Checks the optimised hot functions of the simulations and of
+# BIC_selection against frozen copies of their original
+# implementations, on randomised inputs of varied shape and
+# missingness, and reports the speed-up of each.
+#
+# The ref_* functions below are the implementations as they were
+# before any performance work; do not change them. A new variant of a
+# hot function is adopted once it passes here.
+#
+# Screened citruss fits (screening.py) are checked against the joint
+# fit, with a reference CGGM solver standing in for citruss.
+#
+# Usage:
+#   python equivalence_harness.py [--trials N] [--seed S]
+######################################################################
+
+import argparse
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import scipy.sparse as sp
+
+import BIC_selection
+import active_learning_simulation as als
+import cohort as cohort_layout
+import screening
+import sparse_params
+
+# relative tolerance of float64 and float32 paths against the reference
+RTOL = 1e-8
+RTOL_FLOAT32 = 1e-4
+
+# relative tolerance of a screened fit against the joint fit, both by
+# the iterative reference solver below
+RTOL_SCREEN = 1e-5
+
+
+# %% frozen reference implementations
+def ref_get_params(V, F, Gamma, Psi):
+    """
+    Reconstruct Omega, Xi, and Pi from the input parameters.
+    """
+    Omega = V - Gamma
+    Pi = 2 * Psi
+    Xi = F
+    Xi[np.nonzero(Pi)] = 0
+    return Omega, Xi, Pi
+
+
+def ref_update_dataset(outdir, outprefix,
+                       fysum_large, fysum_small,
+                       fym_large, fym_small,
+                       fyp_large, fyp_small,
+                       fxm_large, fxm_small,
+                       fxp_large, fxp_small,
+                       set_cover_people):
+    ysum_large = np.loadtxt(fysum_large)
+    ysum_small = np.loadtxt(fysum_small)
+    ym_large = np.loadtxt(fym_large)
+    ym_small = np.loadtxt(fym_small)
+    yp_large = np.loadtxt(fyp_large)
+    yp_small = np.loadtxt(fyp_small)
+    xm_large = np.loadtxt(fxm_large)
+    xm_small = np.loadtxt(fxm_small)
+    xp_large = np.loadtxt(fxp_large)
+    xp_small = np.loadtxt(fxp_small)
+
+    Nr, q = ysum_large.shape
+    _, p = xp_large.shape
+
+    mask = np.zeros(Nr, dtype=bool)
+    mask[set_cover_people] = 1
+
+    ysum_small = np.vstack((ysum_small, ysum_large[mask, :]))
+    ym_small = np.vstack((ym_small, ym_large[mask, :]))
+    yp_small = np.vstack((yp_small, yp_large[mask, :]))
+    xm_small = np.vstack((xm_small, xm_large[mask, :]))
+    xp_small = np.vstack((xp_small, xp_large[mask, :]))
+
+    ysum_large = ysum_large[np.logical_not(mask), :]
+    ym_large = ym_large[np.logical_not(mask), :]
+    yp_large = yp_large[np.logical_not(mask), :]
+    xm_large = xm_large[np.logical_not(mask), :]
+    xp_large = xp_large[np.logical_not(mask), :]
+
+    np.savetxt(ref_file_path(outdir, outprefix, "Ysum_small.txt"), ysum_small)
+    np.savetxt(ref_file_path(outdir, outprefix, "Ym_small.txt"), ym_small)
+    np.savetxt(ref_file_path(outdir, outprefix, "Yp_small.txt"), yp_small)
+    np.savetxt(ref_file_path(outdir, outprefix, "Xm_small.txt"), xm_small)
+    np.savetxt(ref_file_path(outdir, outprefix, "Xp_small.txt"), xp_small)
+
+    np.savetxt(ref_file_path(outdir, outprefix, "Ysum_large.txt"), ysum_large)
+    np.savetxt(ref_file_path(outdir, outprefix, "Ym_large.txt"), ym_large)
+    np.savetxt(ref_file_path(outdir, outprefix, "Yp_large.txt"), yp_large)
+    np.savetxt(ref_file_path(outdir, outprefix, "Xm_large.txt"), xm_large)
+    np.savetxt(ref_file_path(outdir, outprefix, "Xp_large.txt"), xp_large)
+
+
+def ref_file_path(outdir, outprefix, fname):
+    return ''.join((outdir, '/', outprefix, fname))
+
+
+def ref_determine_needed_eqtls(xi, pi, ym, yp, xm, xp, Lthresh, Gthresh):
+    needed_eqtls = []
+    N, q = ym.shape
+    _, p = xm.shape
+
+    # check cis eqtls
+    x, y = np.nonzero(pi)
+    for i, j in zip(x, y):
+        print(ref_determine_percentage_ase(ym, yp, j), file=sys.stderr)
+        if ref_determine_percentage_ase(ym, yp, j) < Gthresh:
+            needed_eqtls.append((i, j))
+        elif ref_determine_percentage_heterozygotes_at_locus(xm, xp, i) < Lthresh:
+            needed_eqtls.append((i, j))
+
+    # check trans eqtls
+    x, y = np.nonzero(xi)
+    for i, j in zip(x, y):
+        print(ref_determine_percentage_ase(ym, yp, j), file=sys.stderr)
+        if ref_determine_percentage_ase(ym, yp, j) < Gthresh:
+            print("appending", file=sys.stderr)
+            needed_eqtls.append((i, j))
+        elif ref_determine_percentage_heterozygotes_at_locus(xm, xp, i) < Lthresh:
+            print("appending", file=sys.stderr)
+            needed_eqtls.append((i, j))
+
+    return list(set(needed_eqtls))
+
+
+def ref_determine_percentage_ase(ym, yp, loc):
+    assert all(np.isfinite(ym[:, loc]) == np.isfinite(yp[:, loc])),\
+            "Error: maternal and paternal matrices must have the same ASE availability."
+    return np.mean(np.isfinite(ym[:, loc]))
+
+
+def ref_determine_percentage_heterozygotes_at_locus(Xm, Xp, loc):
+    return np.mean(Xm[:, loc] != Xp[:, loc])
+
+
+def ref_to_set_cover(xm, xp, ym, yp, eqtls_needed):
+    if len(ym) == 0:
+        return [], []
+    people_array = []
+    people_sets = []
+    Nr, q = ym.shape
+    _, p = xm.shape
+    for k in range(Nr):
+        person_set = set()
+        for i, j in eqtls_needed:
+            if xm[k, i] == xp[k, i]:  # person is homozygous
+                continue
+            if not np.isfinite(ym[k, j]):  # no ASE available for this person
+                continue
+            else:
+                assert np.isfinite(yp[k, j]),\
+                        print("Error: maternal and paternal expression " +
+                                "matrices must have the same ASE availability",
+                              file=sys.stderr)
+            person_set.add((i, j))
+        if len(person_set) > 0:
+            people_sets.append(person_set)
+            people_array.append(k)
+    return people_array, people_sets
+
+
+def ref_BIC(Xm, Xp, Ym, Yp, Ysum, Fmat, Vmat, GammaMat, PsiMat, regF,
+            regV, regGamma, regPsi):
+    nnzF = ref_nnz(Fmat)
+    nnzV = ref_nnz(Vmat)
+    nnzGamma = ref_nnz(GammaMat)
+    nnzPsi = ref_nnz(PsiMat)
+    k = nnzF + nnzV + nnzGamma + nnzPsi
+    n = Xm.shape[0]
+
+    llik_val = ref_llik(Xm, Xp, Ym, Yp, Ysum, Fmat, Vmat, GammaMat, PsiMat,
+                        regF, regV, regGamma, regPsi)
+
+    return (k * np.log(n) + 2 * llik_val, k)
+
+
+def ref_llik(Xm, Xp, Ym, Yp, Ysum, Fmat, Vmat, GammaMat, PsiMat, regF,
+             regV, regGamma, regPsi):
+    # get Xs, Xd
+    Xs = Xm + Xp
+    Xd = Xm - Xp
+
+    # get Ys, Yd
+    Ys = Ysum
+    Yd = Ym - Yp
+
+    def get_prob(i):
+        return ref_individual_prob(Xs, Xd, Ys, Yd, Fmat, Vmat, GammaMat, PsiMat, i, log=True)
+
+    llik_arr = np.array([get_prob(i) for i in range(Xs.shape[0])])
+
+    return -np.sum(llik_arr) + \
+        regF * np.sum(np.abs(Fmat)) + \
+        regV * np.sum(np.abs(Vmat)) + \
+        regGamma * np.sum(np.abs(GammaMat)) + \
+        regPsi * np.sum(np.abs(PsiMat))
+
+
+def ref_individual_prob(Xs, Xd, Ys, Yd, Fmat, Vmat, GammaMat, PsiMat, i, log=False):
+    ifin = np.isfinite(Yd[i])
+    yd = Yd[i, ifin]
+
+    if log:
+        return ref_prob_sum_individual(Ys[i], Xs[i], Vmat, Fmat, log=True) + \
+            ref_prob_diff_individual(yd, Xd[i], np.diag(
+                GammaMat[ifin, ifin]), PsiMat[:, ifin], log=True)
+    else:
+        return ref_prob_sum_individual(Ys[i], Xs[i], Vmat, Fmat) * \
+            ref_prob_diff_individual(yd, Xd[i], np.diag(
+                GammaMat[ifin, ifin]), PsiMat[:, ifin])
+
+
+def ref_prob_diff_individual(Yd, Xd, Gamma, Psi, log=False):
+    # number of genes
+    q, _ = Gamma.shape
+
+    gamma_inv = 1 / np.diag(Gamma)
+    if log:
+        c1 = (q/2) * np.log(2 * np.pi)
+        c2 = -0.5 * np.sum(np.log(np.diag(Gamma)))
+        c3 = (-0.5 * (Xd.T @ Psi @ np.diag(gamma_inv) @ Psi.T @ Xd))
+        num = -0.5 * (Yd.T @ Gamma @ Yd - Xd.T @ Psi @ Yd)
+        denom = c1 + c2 + c3
+        return num - denom
+    else:
+        # normalization constant
+        c1 = np.power(2 * np.pi, q/2)
+        c2 = np.power(np.prod(np.diag(Gamma)), -0.5)
+        c3 = np.exp(-0.5 * (Xd.T @ Psi @ np.diag(gamma_inv) @ Psi.T @ Xd))
+        Z = c1 * c2 * c3
+        return np.exp(-0.5 * (Yd.T @ Gamma @ Yd - Xd.T @ Psi @ Yd)) / Z
+
+
+def ref_prob_sum_individual(Ys, Xs, V, F, log=False):
+    # number of genes
+    q, _ = V.shape
+
+    if log:
+        c1 = (q / 2) * np.log(2 * np.pi)
+        c2 = -0.5 * np.log(np.linalg.det(V))
+        c3 = -0.5 * (Xs.T @ F @ np.linalg.inv(V) @ F.T @ Xs)
+        num = -0.5 * (Ys.T @ V @ Ys - Xs.T @ F @ Ys)
+        denom = c1 + c2 + c3
+        return num - denom
+    else:
+        # normalization constant
+        c1 = np.power(2 * np.pi, q / 2)
+        c2 = np.power(np.linalg.det(V), -0.5)
+        c3 = np.exp(-0.5 * (Xs.T @ F @ np.linalg.inv(V) @ F.T @ Xs))
+        Z = c1 * c2 * c3
+        return np.exp(-0.5 * (Ys.T @ V @ Ys - Xs.T @ F @ Ys)) / Z
+
+
+def ref_nnz(matrix):
+    return len(np.nonzero(matrix)[0])
+
+
+# %% randomised inputs
+def random_cohort(rng, N, p, q, missing):
+    """
+    (ysum, ym, yp, xm, xp) for N people; each gene has its own fraction
+    of people without ASE, up to missing (some genes fully missing).
+    """
+    xm = rng.integers(0, 2, (N, p)).astype(np.float64)
+    xp = rng.integers(0, 2, (N, p)).astype(np.float64)
+    ym = rng.normal(size=(N, q))
+    yp = rng.normal(size=(N, q))
+    rates = rng.uniform(0, missing, q)
+    if missing >= 1:
+        rates[rng.integers(q)] = 1
+    absent = rng.random((N, q)) < rates
+    ym[absent] = np.nan
+    yp[absent] = np.nan
+    ysum = np.nan_to_num(ym) + np.nan_to_num(yp) + rng.normal(size=(N, q))
+    return ysum, ym, yp, xm, xp
+
+
+def random_params(rng, p, q, density):
+    """
+    Dense (V, F, Gamma, Psi) as citruss would fit them: V positive
+    definite and sparse-ish, Gamma positive diagonal, F and Psi sparse.
+    """
+    A = rng.normal(size=(q, q)) * (rng.random((q, q)) < density)
+    V = A @ A.T + q * np.eye(q)
+    F = rng.normal(size=(p, q)) * (rng.random((p, q)) < density)
+    Gamma = np.diag(rng.uniform(0.5, 2, q))
+    Psi = rng.normal(size=(p, q)) * (rng.random((p, q)) < density)
+    return V, F, Gamma, Psi
+
+
+def random_shape(rng):
+    return (int(rng.integers(20, 200)), int(rng.integers(2, 30)),
+            int(rng.integers(2, 20)), float(rng.choice([0.0, 0.3, 0.8, 1.0])),
+            float(rng.choice([0.05, 0.2, 0.6])))
+
+
+# %% reference CGGM solver (stands in for citruss in check_screening)
+def reference_cggm_fit(ysum, ym, yp, xm, xp, regV, regF, tol=1e-13,
+                       max_iter=100000):
+    """
+    Proximal gradient solution of the per-sample CGGM objective citruss
+    minimises (see screening):
+      tr(S V) - <Sxy, F> + tr(V^-1 F' Sxx F) / 4 - log det V
+        + regV |V|_1 + regF |F|_1.
+    Gamma and Psi are fit gene by gene (Psi = 0, Gamma_jj the inverse
+    mean square of the gene's ASE, 1 without ASE), which separates
+    across genes as citruss's diagonal-Gamma fit does.
+    Outputs:
+        (V, F, Gamma, Psi) - dense arrays
+    """
+    n = ysum.shape[0]
+    xs = xm + xp
+    Syy, Sxy, Sxx = ysum.T @ ysum / n, xs.T @ ysum / n, xs.T @ xs / n
+
+    def objective(V, F):
+        try:
+            L = np.linalg.cholesky(V)
+        except np.linalg.LinAlgError:
+            return np.inf
+        return np.sum(Syy * V) - np.sum(Sxy * F) + \
+            np.trace(np.linalg.solve(V, F.T @ Sxx @ F)) / 4 - \
+            2 * np.sum(np.log(np.diag(L)))
+
+    def soft(A, t):
+        return np.sign(A) * np.maximum(np.abs(A) - t, 0)
+
+    V = np.diag(1 / np.diag(Syy))
+    F = np.zeros(Sxy.shape)
+    step = 1.0
+    for _ in range(max_iter):
+        Vinv = np.linalg.inv(V)
+        SF = Sxx @ F
+        grad_F = -Sxy + SF @ Vinv / 2
+        grad_V = Syy - Vinv @ F.T @ SF @ Vinv / 4 - Vinv
+        f0 = objective(V, F)
+        step *= 2
+        while True:
+            V_new = soft(V - step * grad_V, step * regV)
+            V_new = (V_new + V_new.T) / 2
+            F_new = soft(F - step * grad_F, step * regF)
+            dV, dF = V_new - V, F_new - F
+            if objective(V_new, F_new) <= f0 + np.sum(grad_V * dV) + \
+                    np.sum(grad_F * dF) + (np.sum(dV ** 2) + np.sum(dF ** 2)) / (2 * step):
+                break
+            step /= 2
+        V, F = V_new, F_new
+        if max(np.max(np.abs(dV)), np.max(np.abs(dF), initial=0)) < tol:
+            break
+
+    yd = ym - yp
+    ase = np.isfinite(yd)
+    sq = np.where(ase, yd, 0) ** 2
+    with np.errstate(divide="ignore", invalid="ignore"):
+        gamma = np.where(ase.any(axis=0), ase.sum(axis=0) / sq.sum(axis=0), 1.0)
+    return V, F, np.diag(gamma), np.zeros(F.shape)
+
+
+def reference_citruss(argv):
+    """
+    Command line of citruss (N q p fYsum fYm fYp fXm fXp prefix regV regF
+    regGamma regPsi) over reference_cggm_fit.
+    """
+    fysum, fym, fyp, fxm, fxp, prefix = argv[3:9]
+    regV, regF = float(argv[9]), float(argv[10])
+    data = [np.loadtxt(f, ndmin=2) for f in (fysum, fym, fyp, fxm, fxp)]
+    for name, mat in zip(sparse_params.PARAM_NAMES,
+                         reference_cggm_fit(*data, regV, regF)):
+        np.savetxt(prefix + name + ".txt", mat)
+
+
+def screening_cohort(rng, N, sizes, eqtl):
+    """
+    (ysum, ym, yp, xm, xp) whose genes fall into independent groups of
+    the given sizes (a shared factor within each group), gene j with an
+    eQTL at SNP j.
+    """
+    q = sum(sizes)
+    xm = rng.integers(0, 2, (N, q)).astype(np.float64)
+    xp = rng.integers(0, 2, (N, q)).astype(np.float64)
+    xs = xm + xp
+    ysum = rng.normal(size=(N, q)) + eqtl * (xs - xs.mean(axis=0))
+    for group in np.split(rng.permutation(q), np.cumsum(sizes)[:-1]):
+        ysum[:, group] += rng.normal(size=(N, 1))
+    ym = rng.normal(size=(N, q))
+    yp = rng.normal(size=(N, q))
+    absent = rng.random((N, q)) < 0.3
+    ym[absent] = np.nan
+    yp[absent] = np.nan
+    return ysum, ym, yp, xm, xp
+
+
+def hidden_dependence_cohort(rng, N):
+    """
+    Six genes in pairs (0, 2), (1, 3) and (4, 5) with a shared factor
+    each, and genes 0 and 1 with an eQTL and noise that cancel in their
+    marginal covariance but not given the genotypes, so the F = 0 screen
+    splits two blocks the joint fit connects.
+    """
+    ysum, ym, yp, xm, xp = screening_cohort(rng, N, [1] * 6, 0.0)
+    x = xm[:, 0] + xp[:, 0]
+    x = x - x.mean()
+    e = ysum[:, 0].copy()
+    ysum[:, 0] += x
+    ysum[:, 1] += x - (x @ x) / (e @ e) * e
+    for genes in ([0, 2], [1, 3], [4, 5]):
+        ysum[:, genes] += rng.normal(size=(N, 1))
+    return ysum, ym, yp, xm, xp
+
+
+# %% comparisons
+class Results:
+    """
+    Collects, per (function, variant), the largest relative error and
+    the total reference and optimised run times.
+    """
+
+    def __init__(self):
+        self.rows = {}
+
+    def add(self, name, variant, ok, err, t_ref, t_new):
+        r = self.rows.setdefault((name, variant), {"trials": 0, "fails": 0,
+                                                   "err": 0.0, "t_ref": 0.0,
+                                                   "t_new": 0.0})
+        r["trials"] += 1
+        r["fails"] += not ok
+        r["err"] = max(r["err"], err)
+        r["t_ref"] += t_ref
+        r["t_new"] += t_new
+
+    def failed(self):
+        return any(r["fails"] for r in self.rows.values())
+
+    def report(self, file=sys.stdout):
+        print("{:<24}{:<24}{:>7}{:>7}{:>12}{:>11}{:>11}{:>10}".format(
+            "function", "variant", "trials", "fails", "max rel err",
+            "ref (s)", "new (s)", "speed-up"), file=file)
+        for (name, variant), r in self.rows.items():
+            print("{:<24}{:<24}{:>7}{:>7}{:>12.2e}{:>11.4f}{:>11.4f}{:>9.1f}x".format(
+                name, variant, r["trials"], r["fails"], r["err"], r["t_ref"],
+                r["t_new"], r["t_ref"] / max(r["t_new"], 1e-12)), file=file)
+
+
+def timed(f, *args, **kwargs):
+    start = time.perf_counter()
+    with contextlib.redirect_stderr(io.StringIO()):
+        out = f(*args, **kwargs)
+    return out, time.perf_counter() - start
+
+
+def rel_err(a, b):
+    a = sp.csr_matrix(a).toarray() if sp.issparse(a) else np.asarray(a, dtype=np.float64)
+    b = sp.csr_matrix(b).toarray() if sp.issparse(b) else np.asarray(b, dtype=np.float64)
+    if a.shape != b.shape:
+        return np.inf
+    if not np.array_equal(np.isnan(a), np.isnan(b)):
+        return np.inf
+    a, b = np.nan_to_num(a), np.nan_to_num(b)
+    return float(np.max(np.abs(a - b), initial=0) / max(np.max(np.abs(b), initial=0), 1e-300))
+
+
+def check_get_params(results, params):
+    V, F, Gamma, Psi = params
+    F_ref, F_new = F.copy(), F.copy()
+    ref, t_ref = timed(ref_get_params, V, F_ref, Gamma, Psi)
+    new, t_new = timed(als.get_params, V, F_new, Gamma, Psi)
+    # the original zeroes the Pi support of F itself (Xi is F)
+    err = max([rel_err(a, b) for a, b in zip(new, ref)] + [rel_err(F_new, F_ref)])
+    results.add("get_params", "dense (F mutated)", err == 0, err, t_ref, t_new)
+
+    sparse = [sp.csr_matrix(A) for A in (V, F, Gamma, Psi)]
+    new, t_new = timed(als.get_params, *sparse)
+    err = max([rel_err(a, b) for a, b in zip(new, ref)] + [rel_err(sparse[1], F)])
+    results.add("get_params", "sparse (F untouched)", err == 0, err, t_ref, t_new)
+
+
+def check_needed_eqtls(results, data, params, rng):
+    ysum, ym, yp, xm, xp = data
+    _, xi, pi = ref_get_params(*(A.copy() for A in params))
+    L, G = rng.uniform(0.2, 0.95, 2)
+    ref, t_ref = timed(ref_determine_needed_eqtls, xi, pi, ym, yp, xm, xp, L, G)
+    new, t_new = timed(als.determine_needed_eqtls, xi, pi, ym, yp, xm, xp, L, G)
+    ok = set(map(tuple, new)) == set(map(tuple, ref))
+    results.add("determine_needed_eqtls", "arrays", ok, 0.0 if ok else np.inf, t_ref, t_new)
+
+    # the simulation keeps the counters up to date; time the query only
+    coverage = als.SequencedCoverage(ym, yp, xm, xp)
+    new, t_new = timed(als.determine_needed_eqtls, sp.csr_matrix(xi), sp.csr_matrix(pi),
+                       None, None, None, None, L, G, coverage=coverage)
+    ok = set(map(tuple, new)) == set(map(tuple, ref))
+    results.add("determine_needed_eqtls", "coverage counters", ok,
+                0.0 if ok else np.inf, t_ref, t_new)
+    return ref
+
+
+def check_to_set_cover(results, data, needed):
+    _, ym, yp, xm, xp = data
+    ref, t_ref = timed(ref_to_set_cover, xm, xp, ym, yp, needed)
+    new, t_new = timed(als.to_set_cover, xm, xp, ym, yp, needed)
+    ok = list(new[0]) == list(ref[0]) and list(new[1]) == list(ref[1])
+    results.add("to_set_cover", "arrays", ok, 0.0 if ok else np.inf, t_ref, t_new)
+
+
+def check_update_dataset(results, data, rng, tmpdir):
+    N = data[0].shape[0]
+    n_small = int(rng.integers(1, N // 2))
+    small_mask = np.zeros(N, dtype=bool)
+    small_mask[rng.choice(N, n_small, replace=False)] = True
+    small = [A[small_mask] for A in data]
+    large = [A[~small_mask] for A in data]
+    people = rng.choice(N - n_small, int(rng.integers(1, N - n_small)), replace=False)
+
+    names = ("Ysum", "Ym", "Yp", "Xm", "Xp")
+    files = []
+    for name, s, l in zip(names, small, large):
+        files += [ref_file_path(tmpdir, "in", name + "_large.txt"),
+                  ref_file_path(tmpdir, "in", name + "_small.txt")]
+        np.savetxt(files[-2], l)
+        np.savetxt(files[-1], s)
+    _, t_ref = timed(ref_update_dataset, tmpdir, "ref", *files, people)
+
+    cohort = cohort_layout.Cohort.from_parts(small, large)
+    _, t_new = timed(als.update_dataset, tmpdir, "new", cohort, people)
+
+    # sequenced rows in the same order; the pool in original-ID order
+    order = np.argsort(cohort.large_ids)
+    err = 0.0
+    for name, s, l in zip(names, cohort.small, cohort.large):
+        for part, mem in (("small", s), ("large", l[order])):
+            # ndmin: a pool left with one person is a one-row file
+            ref = np.loadtxt(ref_file_path(tmpdir, "ref", name + "_" + part + ".txt"),
+                             ndmin=2)
+            new = np.loadtxt(ref_file_path(tmpdir, "new", name + "_" + part + ".txt"),
+                             ndmin=2)
+            ids_order = slice(None) if part == "small" else order
+            err = max(err, rel_err(mem, ref), rel_err(new[ids_order], ref))
+    results.add("update_dataset", "cohort swap", err == 0, err, t_ref, t_new)
+
+
+def check_likelihood(results, data, params, rng):
+    ysum, ym, yp, xm, xp = data
+    V, F, Gamma, Psi = params
+    regs = tuple(rng.uniform(0, 0.5, 4))
+    ref_l, t_ref_l = timed(ref_llik, xm, xp, ym, yp, ysum, F, V, Gamma, Psi, *regs)
+    ref_b, t_ref_b = timed(ref_BIC, xm, xp, ym, yp, ysum, F, V, Gamma, Psi, *regs)
+    sparse = [sp.csr_matrix(A) for A in (V, F, Gamma, Psi)]
+
+    # the last field overrides BIC_selection settings, so that the sparse
+    # factorisation and the dense path of a sparse V, and the sparse F/Psi
+    # products, are checked whatever the size and density of the inputs
+    keep_sparse = {"SPARSE_FP_DENSITY": 1.0, "SPARSE_FP_MIN_SIZE": 0}
+    variants = (
+        ("dense", (V, F, Gamma, Psi), {}, RTOL, {}),
+        ("chunked", (V, F, Gamma, Psi), {"chunk_size": 7}, RTOL, {}),
+        ("sparse, V factorised", sparse, {}, RTOL, {"SPARSE_V_DENSITY": 1.0}),
+        ("sparse, dense V", sparse, {}, RTOL, {"SPARSE_V_DENSITY": -1.0}),
+        ("sparse F, Psi", sparse, {}, RTOL, keep_sparse),
+        ("float32", (V, F, Gamma, Psi), {"dtype": np.float32}, RTOL_FLOAT32, {}),
+    )
+    for variant, (v, f, g, s), kwargs, rtol, settings in variants:
+        with scoring_settings(settings):
+            new_l, t_new = timed(BIC_selection.llik, xm, xp, ym, yp, ysum, f, v, g, s,
+                                 *regs, **kwargs)
+            err = rel_err(new_l, ref_l)
+            results.add("llik", variant, err <= rtol, err, t_ref_l, t_new)
+
+            new_b, t_new = timed(BIC_selection.BIC, xm, xp, ym, yp, ysum, f, v, g, s,
+                                 *regs, **kwargs)
+            err = max(rel_err(new_b[0], ref_b[0]), 0.0 if new_b[1] == ref_b[1] else np.inf)
+            results.add("BIC", variant, err <= rtol, err, t_ref_b, t_new)
+
+    (bic, k, llik_val), t_new = timed(BIC_selection.score_param_sets, xm, xp, ym, yp,
+                                      ysum, [sparse], [regs])
+    err = max(rel_err(llik_val[0], ref_l), rel_err(bic[0], ref_b[0]),
+              0.0 if k[0] == ref_b[1] else np.inf)
+    results.add("BIC", "score_param_sets", err <= RTOL, err, t_ref_b, t_new)
+
+
+def check_screening(results, rng, tmpdir):
+    """
+    Screened fit (citruss replaced by reference_citruss) against the
+    joint reference fit, on data whose genes split into blocks and on
+    data where part of the F = 0 split must be undone by the optimality
+    check.
+    """
+    cases = (
+        ("block-diagonal data", screening_cohort(rng, 600, [4, 3, 2, 1, 1], 0.5),
+         (0.35, 0.05)),
+        ("merged on KKT check", hidden_dependence_cohort(rng, 600),
+         (0.3, 0.01)),
+    )
+    for variant, data, (regV, regF) in cases:
+        files = []
+        for name, A in zip(("Ysum", "Ym", "Yp", "Xm", "Xp"), data):
+            files.append(os.path.join(tmpdir, "screen_in_" + name + ".txt"))
+            np.savetxt(files[-1], A)
+        ref, t_ref = timed(reference_cggm_fit, *data, regV, regF)
+        prefix = os.path.join(tmpdir, "screened_")
+        nblocks, t_new = timed(screening.fit_screened, *files, prefix, regV, regF,
+                               0.1, 0.1, os.path.abspath(__file__))
+        # both cases must end up split, or nothing was screened
+        if nblocks == 0:
+            err = np.inf
+        else:
+            err = max(rel_err(np.loadtxt(prefix + name + ".txt", ndmin=2), A)
+                      for name, A in zip(sparse_params.PARAM_NAMES, ref))
+        results.add("fit_screened", variant, err <= RTOL_SCREEN, err, t_ref, t_new)
+
+
+@contextlib.contextmanager
+def scoring_settings(settings):
+    """
+    Score with the given BIC_selection module constants overridden, e.g.
+    SPARSE_V_DENSITY = 1.0 to always factorise a sparse V or -1.0 to
+    never do so.
+    """
+    old = {name: getattr(BIC_selection, name) for name in settings}
+    for name, value in settings.items():
+        setattr(BIC_selection, name, value)
+    try:
+        yield
+    finally:
+        for name, value in old.items():
+            setattr(BIC_selection, name, value)
+
+
+# %% command line
+def main():
+    parser = argparse.ArgumentParser(description="reference vs optimised equivalence")
+    parser.add_argument("--trials", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    results = Results()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for _ in range(args.trials):
+            N, p, q, missing, density = random_shape(rng)
+            data = random_cohort(rng, N, p, q, missing)
+            params = random_params(rng, p, q, density)
+
+            check_get_params(results, params)
+            needed = check_needed_eqtls(results, data, params, rng)
+            check_to_set_cover(results, data, needed)
+            check_update_dataset(results, data, rng, tmpdir)
+            check_likelihood(results, data, params, rng)
+        # the reference solver is slow; one draw of each case is enough
+        check_screening(results, rng, tmpdir)
+
+    results.report()
+    if results.failed():
+        print("optimised paths differ from the reference", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    # check_screening runs this file as citruss (13 arguments)
+    if len(sys.argv) == 14:
+        reference_citruss(sys.argv[1:])
+    else:
+        main()
@@ -0,0 +1,183 @@
+######################################################################
+# evaluate_recovery.py
+# Compares each iteration's estimated Xi (trans eQTLs) and Pi (cis
+# eQTLs) with the simulation ground truth, for the active and random
+# arms, and writes a learning-curve table per replicate.
+#
+# The fits are read from the run archive (run_archive.py) if the run
+# directory has one, otherwise from the per-iteration files.
+#
+# Usage:
+#   python evaluate_recovery.py TRUE_XI TRUE_PI RUN_DIR [RUN_DIR ...]
+######################################################################
+
+import argparse
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import scipy.sparse as sp
+
+import run_archive
+import sparse_params
+
+# iterations stacked into one sparse block
+BLOCK_SIZE = 50
+
+# output prefix of each arm's fits, relative to the run directory
+ARMS = {"active": "{}", "random": "{}random"}
+
+COLUMNS = ("iteration", "arm",
+           "cis_precision", "cis_recall", "cis_f1",
+           "trans_precision", "trans_recall", "trans_f1",
+           "pi_error", "xi_error")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="eQTL recovery learning curves")
+    parser.add_argument("true_xi", help="text file with the true Xi (p x q)")
+    parser.add_argument("true_pi", help="text file with the true Pi (p x q)")
+    parser.add_argument("run_dirs", nargs="+", help="one directory per replicate")
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    evaluate_replicates(args.run_dirs, np.loadtxt(args.true_xi),
+                        np.loadtxt(args.true_pi), workers=args.workers)
+
+
+# ---------------------------------------------------------------------
+# learning curves for many replicates
+# ---------------------------------------------------------------------
+def evaluate_replicates(run_dirs, true_xi, true_pi, workers=None,
+                        fname="learning_curve.tsv"):
+    """
+    Evaluate every replicate in parallel, one process per replicate, and
+    save each learning curve to run_dir/fname.
+    Outputs:
+        curves (list) - one structured array per replicate (see COLUMNS)
+    """
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        curves = list(pool.map(evaluate_run,
+                               run_dirs,
+                               [true_xi] * len(run_dirs),
+                               [true_pi] * len(run_dirs)))
+    for run_dir, curve in zip(run_dirs, curves):
+        save_curve(os.path.join(run_dir, fname), curve)
+    return curves
+
+
+def evaluate_run(run_dir, true_xi, true_pi, block_size=BLOCK_SIZE):
+    """
+    Learning curve of one replicate: one row per (arm, iteration).
+    """
+    farchive = os.path.join(run_dir, run_archive.ARCHIVE_NAME)
+    archive = run_archive.RunArchive(farchive) if os.path.exists(farchive) else None
+
+    rows = []
+    for arm, prefix in ARMS.items():
+        if archive is not None:
+            iters = archive.iterations(arm, "F")
+        else:
+            iters = find_iterations(run_dir, prefix)
+        for start in range(0, len(iters), block_size):
+            block = iters[start:start + block_size]
+            if archive is not None:
+                Fs = [archive.get(i, arm, "F") for i in block]
+                Psis = [archive.get(i, arm, "Psi") for i in block]
+            else:
+                Fs = [sparse_params.load_param(
+                    os.path.join(run_dir, prefix.format(i)), "F") for i in block]
+                Psis = [sparse_params.load_param(
+                    os.path.join(run_dir, prefix.format(i)), "Psi") for i in block]
+            stats = recovery_stats(stack(Fs), stack(Psis), true_xi, true_pi)
+            for k, i in enumerate(block):
+                rows.append((i, arm) + tuple(stats[name][k] for name in COLUMNS[2:]))
+    if archive is not None:
+        archive.close()
+
+    dtype = [("iteration", int), ("arm", "U6")] + [(name, float) for name in COLUMNS[2:]]
+    return np.array(rows, dtype=dtype)
+
+
+def find_iterations(run_dir, prefix):
+    """
+    Sorted iterations for which a fit with the given output prefix
+    (e.g. "{}random") exists in run_dir.
+    """
+    pattern = re.compile("^" + re.escape(prefix).replace(r"\{\}", r"(\d+)") +
+                         r"F\.(txt|npz)$")
+    iters = set()
+    for fname in os.listdir(run_dir):
+        match = pattern.match(fname)
+        if match:
+            iters.add(int(match.group(1)))
+    return sorted(iters)
+
+
+# ---------------------------------------------------------------------
+# stacked evaluation
+# ---------------------------------------------------------------------
+def stack(mats):
+    """
+    Stack p x q matrices into one CSR matrix with one flattened matrix
+    per row.
+    """
+    return sp.vstack([sp.csr_matrix(m).reshape(1, -1) for m in mats]).tocsr()
+
+
+def recovery_stats(F_stack, Psi_stack, true_xi, true_pi):
+    """
+    Support recovery and error norms for a block of iterations at once.
+    Inputs:
+        F_stack (sp.csr_matrix) - niter x (p*q) estimated F, see stack()
+        Psi_stack (sp.csr_matrix) - niter x (p*q) estimated Psi
+        true_xi (np.array) - p x q true trans effects
+        true_pi (np.array) - p x q true cis effects
+    Outputs:
+        stats (dict) - arrays of length niter keyed by COLUMNS[2:]
+    """
+    # same reconstruction as get_params: Pi = 2 Psi, Xi = F off the Pi support
+    Pi = 2 * Psi_stack
+    Xi = F_stack - F_stack.multiply(Pi != 0)
+    Pi.eliminate_zeros()
+    Xi.eliminate_zeros()
+
+    stats = {}
+    for name, est, truth in (("cis", Pi, true_pi), ("trans", Xi, true_xi)):
+        truth = np.ravel(sparse_params.to_dense(truth))
+        true_support = (truth != 0).astype(np.float64)
+        est_support = est.copy()
+        est_support.data = np.ones_like(est_support.data)
+
+        tp = est_support @ true_support
+        nest = np.diff(est_support.indptr)
+        ntrue = true_support.sum()
+        with np.errstate(divide="ignore", invalid="ignore"):
+            precision = tp / nest
+            recall = tp / ntrue
+            f1 = 2 * tp / (nest + ntrue)
+        stats[name + "_precision"] = precision
+        stats[name + "_recall"] = recall
+        stats[name + "_f1"] = f1
+
+    # ||est - truth||_F for every row, against the truth repeated per row
+    for name, est, truth in (("pi", Pi, true_pi), ("xi", Xi, true_xi)):
+        truth = sp.csr_matrix(np.ravel(sparse_params.to_dense(truth)))
+        diff = est - sp.vstack([truth] * est.shape[0])
+        stats[name + "_error"] = np.sqrt(np.ravel(diff.multiply(diff).sum(axis=1)))
+    return stats
+
+
+def save_curve(fname, curve):
+    """
+    Save a learning curve as a tab-separated table with a header.
+    """
+    with open(fname, "w") as f:
+        f.write("\t".join(COLUMNS) + "\n")
+        for row in curve:
+            f.write("\t".join(str(row[name]) for name in COLUMNS) + "\n")
+
+
+if __name__ == '__main__':
+    main()
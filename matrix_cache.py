@@ -0,0 +1,164 @@
+######################################################################
+# matrix_cache.py
+# Process-wide cache of parsed text matrices, so that a file read
+# several times in one process (the BIC data across grid points, a
+# work_queue worker's jobs on the same data) is parsed only once. Files
+# read once, or only for their shape (text_shape), bypass it.
+######################################################################
+
+import collections
+import os
+import sys
+import threading
+
+import numpy as np
+
+# bytes of parsed matrices kept in memory; least recently used go first
+# (see set_max_bytes)
+MAX_BYTES = 1 << 28
+
+
+class MatrixCache:
+    """
+    LRU cache of np.loadtxt results keyed by (path, dtype). An entry is
+    only reused while the file's size and mtime are unchanged, so files
+    rewritten by another process are parsed again. Writes made through
+    savetxt() below or through async_writer.AsyncWriter drop the entry
+    straight away.
+
+    Cached arrays are shared between callers and therefore read-only;
+    callers that modify a matrix must copy it first. Matrices larger than
+    max_bytes are returned without being cached.
+    """
+
+    def __init__(self, max_bytes=MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def load(self, fname, dtype=np.float64):
+        """
+        np.loadtxt(fname, dtype=dtype), parsed at most once per version of
+        the file.
+        """
+        path = os.path.abspath(fname)
+        key = (path, np.dtype(dtype).str)
+        st = os.stat(path)
+        version = (st.st_size, st.st_mtime_ns)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == version:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        array = np.loadtxt(path, dtype=dtype)
+        array.flags.writeable = False
+        with self._lock:
+            self._drop(key)
+            if array.nbytes <= self.max_bytes:
+                self._entries[key] = (version, array)
+                self.nbytes += array.nbytes
+                self._evict()
+        return array
+
+    def resize(self, max_bytes):
+        """
+        Change the cap, evicting least recently used entries to fit.
+        """
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def invalidate(self, fname):
+        """
+        Forget every cached parse of fname, whatever its dtype.
+        """
+        path = os.path.abspath(fname)
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == path]:
+                self._drop(key)
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses,
+                    "evictions": self.evictions,
+                    "invalidations": self.invalidations,
+                    "entries": len(self._entries), "bytes": self.nbytes}
+
+    def _evict(self):
+        while self.nbytes > self.max_bytes:
+            _, (_, old) = self._entries.popitem(last=False)
+            self.nbytes -= old.nbytes
+            self.evictions += 1
+
+    def _drop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.nbytes -= entry[1].nbytes
+
+
+# shared by every loader in the process
+CACHE = MatrixCache()
+
+
+def load_matrix(fname, dtype=np.float64):
+    """
+    Parse a text matrix through the process-wide cache. The result is
+    read-only.
+    """
+    return CACHE.load(fname, dtype)
+
+
+def invalidate(fname):
+    CACHE.invalidate(fname)
+
+
+def set_max_bytes(max_bytes):
+    """
+    Cap the process-wide cache at max_bytes (0 disables caching).
+    """
+    CACHE.resize(max_bytes)
+
+
+def text_shape(fname):
+    """
+    (rows, columns) of a whitespace-delimited text matrix, counted from
+    the file without parsing or caching it; for files read only for
+    their shape.
+    """
+    nrow, ncol = 0, 0
+    with open(fname, "rb") as f:
+        for line in f:
+            if line.strip():
+                if nrow == 0:
+                    ncol = len(line.split())
+                nrow += 1
+    return nrow, ncol
+
+
+def savetxt(fname, array, **kwargs):
+    """
+    np.savetxt that also drops the cached parse of fname.
+    """
+    np.savetxt(fname, array, **kwargs)
+    CACHE.invalidate(fname)
+
+
+def report(file=sys.stderr):
+    print("matrix cache: {hits} hits, {misses} misses, {evictions} evictions, "
+          "{invalidations} invalidations, {entries} entries "
+          "({mb:.1f} MB)".format(mb=CACHE.nbytes / 2**20, **CACHE.stats()),
+          file=file)
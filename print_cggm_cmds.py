@@ -6,6 +6,8 @@
 import sys
 import subprocess
 
+import work_queue
+
 GENERAL_PREFIX = "/mnt/c/Users/apare/Desktop/KimResearchGroup/Spring2022/"
 TO_CITRUSS = GENERAL_PREFIX + "mlcggm/Mega-sCGGM_python/citruss.py"
 TO_DATA = GENERAL_PREFIX + "input_simulation/simulateCode2/missing"
@@ -17,8 +19,12 @@ P = 400
 MISSING_RATIOS = [35] # [0, 5, 10, 15, 20, 25, 30, 35, 40, 45, 50]
 NSIMS = 1 # NSIMS = 10
 
+# if set, fits are submitted to this work_queue spool directory instead of
+# being run here; start workers with `python work_queue.py worker SPOOL`
+SPOOL_DIR = None
+
 
-def main():
+def main(spool_dir=SPOOL_DIR):
     fname_out = "cmds.sh"
 
     reg_v = 0.01
@@ -44,7 +50,10 @@ def main():
                         xp_fname,
                         output_fname,
                         str(reg_v), str(reg_f), str(reg_gamma), str(reg_psi)]
-            subprocess.run(commands, check=True)
+            if spool_dir is None:
+                subprocess.run(commands, check=True)
+            else:
+                work_queue.submit(spool_dir, "citruss", {"cmd": commands})
 
 
 if __name__ == '__main__':
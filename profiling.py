@@ -0,0 +1,182 @@
+######################################################################
+# profiling.py
+# Opt-in per-phase time and peak-memory tracking for the simulation
+# entry points and BIC_selection.main.
+######################################################################
+
+import contextlib
+import cProfile
+import os
+import resource
+import sys
+import time
+import tracemalloc
+
+_NULL = contextlib.nullcontext()
+
+
+class Profiler:
+    """
+    Records, per named phase, the number of calls, wall time, the
+    tracemalloc peak (Python and numpy allocations), the peak resident
+    set size of this process and the RSS of child processes (e.g.
+    citruss) that finished during the phase. The kernel only keeps the
+    largest RSS of all finished children, so a phase is charged that
+    value only if it rose during the phase, i.e. one of its children
+    exceeded every earlier one; other phases show 0. Optionally writes
+    a cProfile dump per iteration to pstats_dir.
+
+    When enabled is False, phase() and next_iteration() return
+    immediately and tracemalloc is never started.
+
+    Usage:
+        profiler = Profiler(enabled=True)
+        profiler.next_iteration(0)
+        with profiler.phase("fit"):
+            ...
+        profiler.report()
+    """
+
+    def __init__(self, enabled=False, pstats_dir=None):
+        self.enabled = enabled
+        self.pstats_dir = pstats_dir
+        self.phases = {}
+        self._stack = []
+        self._cprofile = None
+        self._iteration = None
+        if enabled and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def phase(self, name):
+        """
+        Context manager timing one phase; phases may be nested.
+        """
+        if not self.enabled:
+            return _NULL
+        return self._phase(name)
+
+    @contextlib.contextmanager
+    def _phase(self, name):
+        self._checkpoint_parent()
+        frame = {"py_peak": 0, "rss_peak": 0}
+        self._stack.append(frame)
+        child_start = _child_rss_peak()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            py_peak = max(frame["py_peak"], tracemalloc.get_traced_memory()[1])
+            rss_peak = max(frame["rss_peak"], _rss_peak())
+            child_now = _child_rss_peak()
+            child_peak = child_now if child_now > child_start else 0
+            self._stack.pop()
+            if self._stack:
+                parent = self._stack[-1]
+                parent["py_peak"] = max(parent["py_peak"], py_peak)
+                parent["rss_peak"] = max(parent["rss_peak"], rss_peak)
+            tracemalloc.reset_peak()
+            _reset_rss_peak()
+
+            record = self.phases.setdefault(name, {"calls": 0, "time": 0.0,
+                                                   "py_peak": 0, "rss_peak": 0,
+                                                   "child_rss_peak": 0})
+            record["calls"] += 1
+            record["time"] += elapsed
+            record["py_peak"] = max(record["py_peak"], py_peak)
+            record["rss_peak"] = max(record["rss_peak"], rss_peak)
+            record["child_rss_peak"] = max(record["child_rss_peak"], child_peak)
+
+    def _checkpoint_parent(self):
+        # fold the peaks reached so far into the enclosing phase before
+        # the counters are reset for the new one
+        if self._stack:
+            parent = self._stack[-1]
+            parent["py_peak"] = max(parent["py_peak"],
+                                    tracemalloc.get_traced_memory()[1])
+            parent["rss_peak"] = max(parent["rss_peak"], _rss_peak())
+        tracemalloc.reset_peak()
+        _reset_rss_peak()
+
+    def next_iteration(self, label):
+        """
+        Finish the cProfile dump of the previous iteration (if any) and
+        start one for iteration label. Only active with pstats_dir set.
+        """
+        if not self.enabled or self.pstats_dir is None:
+            return
+        self._dump_iteration()
+        self._iteration = label
+        self._cprofile = cProfile.Profile()
+        self._cprofile.enable()
+
+    def _dump_iteration(self):
+        if self._cprofile is None:
+            return
+        self._cprofile.disable()
+        os.makedirs(self.pstats_dir, exist_ok=True)
+        self._cprofile.dump_stats(os.path.join(
+            self.pstats_dir, "{}.pstats".format(self._iteration)))
+        self._cprofile = None
+
+    def report(self, file=sys.stderr):
+        """
+        Print the phases ranked by total time and by peak memory.
+        """
+        if not self.enabled:
+            return
+        self._dump_iteration()
+        header = "{:<24}{:>7}{:>12}{:>14}{:>14}{:>16}".format(
+            "phase", "calls", "time (s)", "py peak (MB)", "rss peak (MB)",
+            "child rss (MB)")
+
+        def line(name, r):
+            return "{:<24}{:>7}{:>12.2f}{:>14.1f}{:>14.1f}{:>16.1f}".format(
+                name, r["calls"], r["time"], r["py_peak"] / 2**20,
+                r["rss_peak"] / 2**20, r["child_rss_peak"] / 2**20)
+
+        for title, key in (("by time", "time"), ("by memory", "py_peak")):
+            print("profile, phases ranked {}:".format(title), file=file)
+            print(header, file=file)
+            for name, r in sorted(self.phases.items(),
+                                  key=lambda item: item[1][key], reverse=True):
+                print(line(name, r), file=file)
+
+
+# shared disabled profiler, used as the default argument
+DISABLED = Profiler(enabled=False)
+
+
+# %% resident set size
+def _rss_peak():
+    """
+    Peak resident set size of this process in bytes since the last
+    _reset_rss_peak (since start if the kernel cannot reset it).
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # ru_maxrss is in kilobytes on Linux, bytes on macOS
+    scale = 1 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+def _reset_rss_peak():
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def _child_rss_peak():
+    """
+    Largest resident set size of any finished child process in bytes,
+    over the lifetime of this process.
+    """
+    scale = 1 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale
@@ -3,9 +3,19 @@
 # active_learning_simulation.py
 ############################################################
 
+import functools
 import sys
 import numpy as np
 import subprocess
+import scipy.sparse as sp
+
+import async_writer
+import cohort as cohort_layout
+import matrix_cache
+import profiling
+import screening
+import run_archive
+import sparse_params
 
 # some other parameters
 THRESHOLD = 200
@@ -13,6 +23,29 @@ MAXITER = 200
 LTHRESH = 0.85
 GTHRESH = 0.85
 
+# write each round's snapshot from a background thread while citruss runs
+ASYNC_WRITES = True
+
+# per-phase time/memory report (and cProfile dumps per iteration if
+# PSTATS_DIR is set); off by default
+PROFILE = False
+PSTATS_DIR = None
+
+# precision of the cohort matrices held in memory and written for citruss;
+# np.float32 halves memory and the size of the text snapshots
+DTYPE = np.float64
+
+# also append every snapshot and fit to the run archive shared with the
+# active arm (run_archive.py); the *_large_random text files are then not
+# written, and the starting split is read from the archive if it is there.
+# Only one arm may append to the archive at a time, so run the arms one
+# after the other with the archive on.
+ARCHIVE = False
+
+# fit the genes in independent blocks, each with its own citruss run,
+# where the joint fit is block diagonal in V (see screening)
+SCREEN = False
+
 # directory names
 ACTIVE_LEARNING_DIR = "active_learning_sims"
 
@@ -49,7 +82,9 @@ def random_learning_sim(start_ysum_large, start_ym_large, start_yp_large, start_
                         maxiter=MAXITER, general_prefix=GENERAL_PREFIX,
                         active_learning_dir=ACTIVE_LEARNING_DIR,
                         to_citruss=TO_CITRUSS, to_data=TO_DATA,
-                        threshold=THRESHOLD):
+                        threshold=THRESHOLD, async_writes=ASYNC_WRITES,
+                        profile=PROFILE, pstats_dir=PSTATS_DIR, dtype=DTYPE,
+                        archive=ARCHIVE, screen=SCREEN):
     """
     Run the active learning simulation.
     Inputs:
@@ -65,14 +100,33 @@ def random_learning_sim(start_ysum_large, start_ym_large, start_yp_large, start_
         to_citruss (str) - path to citruss.py command
         threshold (int) - minimum number of ASE needed for each gene
         prop (float) - initial proportion of observations sampled
+        async_writes (bool) - save snapshots from a background thread, so
+                              the *_large files are written during the fit
+        profile (bool) - record time and peak memory of each phase and
+                         print a summary at the end
+        pstats_dir (str) - with profile, save a cProfile dump per iteration
+        dtype (np.dtype) - precision of the cohort matrices
+        archive (bool) - append snapshots and fits to the run archive
+        screen (bool) - fit V in independent gene blocks where the
+                        screening rule allows (see screening)
     Outputs:
         None - files saved to active_learning_dir
     """
-    initialize_dataset(active_learning_dir, '0', start_ysum_small, start_ym_small, start_yp_small,
-                       start_xm_small, start_xp_small, start_ysum_large, start_ym_large, start_yp_large,
-                       start_xm_large, start_xp_large)
+    writer = async_writer.AsyncWriter(background=async_writes)
+    profiler = profiling.Profiler(enabled=profile, pstats_dir=pstats_dir)
+    if archive:
+        archive = run_archive.RunArchive(general_prefix + to_data + active_learning_dir +
+                                         "/" + run_archive.ARCHIVE_NAME, "a")
+    else:
+        archive = None
+    with profiler.phase("initialize_dataset"):
+        cohort = initialize_dataset(active_learning_dir, '0', start_ysum_small, start_ym_small, start_yp_small,
+                                    start_xm_small, start_xp_small, start_ysum_large, start_ym_large, start_yp_large,
+                                    start_xm_large, start_xp_large, writer=writer, dtype=dtype,
+                                    archive=archive)
 
     for iiter in range(maxiter):
+        profiler.next_iteration(iiter)
         fysum = general_prefix + to_data + active_learning_dir + \
             "/{}Ysum_small_random.txt".format(iiter)
         fym = general_prefix + to_data + active_learning_dir + \
@@ -84,21 +138,18 @@ def random_learning_sim(start_ysum_large, start_ym_large, start_yp_large, start_
         fxp = general_prefix + to_data + active_learning_dir + \
             "/{}Xp_small_random.txt".format(iiter)
 
-        run_citruss(fysum, fym, fyp, fxm, fxp,
-                    general_prefix + to_data +
-                    active_learning_dir + "/" + str(iiter) + "random",
-                    0.01, 0.01, 0.01, 0.01, to_citruss)
-
-        V = np.loadtxt(general_prefix + to_data +
-                       active_learning_dir + "/" + str(iiter) + "V.txt")
-        F = np.loadtxt(general_prefix + to_data +
-                       active_learning_dir + "/" + str(iiter) + "F.txt")
-        Gamma = np.loadtxt(general_prefix + to_data +
-                           active_learning_dir + "/" + str(iiter) + "Gamma.txt")
-        Psi = np.loadtxt(general_prefix + to_data +
-                         active_learning_dir + "/" + str(iiter) + "Psi.txt")
-
-        Omega, Xi, Pi = get_params(V, F, Gamma, Psi)
+        with profiler.phase("fit"):
+            # citruss reads the sequenced set from disk
+            writer.wait([fysum, fym, fyp, fxm, fxp])
+            run_citruss(fysum, fym, fyp, fxm, fxp,
+                        general_prefix + to_data +
+                        active_learning_dir + "/" + str(iiter) + "random",
+                        0.01, 0.01, 0.01, 0.01, to_citruss, screen=screen)
+            # the random arm samples blindly and never reads its fits back
+            # (nor the active arm's, which skipped rounds do not write)
+            if archive is not None:
+                archive_fit(archive, iiter, *sparse_params.load_params(
+                    general_prefix + to_data + active_learning_dir + "/" + str(iiter) + "random"))
 
         # find people heterozygous for these traits in the remaining samples
         fysum_large = general_prefix + to_data + \
@@ -126,22 +177,27 @@ def random_learning_sim(start_ysum_large, start_ym_large, start_yp_large, start_
         # ym_large = np.loadtxt(fym_large)
         # yp_large = np.loadtxt(fyp_large)
 
-        # get number of samples needed
-        fysum_next = general_prefix + to_data + \
-            active_learning_dir + "/" + str(iiter+1) + "Ysum_small.txt"
-        N = np.loadtxt(fysum_large).shape[0]
-        nnext = np.loadtxt(
-            fysum_next).shape[0] - np.loadtxt(fysum_small).shape[0]
-        print('nnext:', nnext)
-        print('N:', N)
-        new_people = np.random.choice(np.arange(0, N, 1, dtype=np.int64), nnext,
-                                      replace=False)
+        with profiler.phase("random_sample"):
+            # checkpoint: the pool rows are reordered in place by
+            # update_dataset, so this round's snapshots (the pool's
+            # written during the fit) must be on stable storage first
+            writer.flush()
+
+            # get number of samples needed
+            fysum_next = general_prefix + to_data + \
+                active_learning_dir + "/" + str(iiter+1) + "Ysum_small.txt"
+            N = cohort.N - cohort.n_seq
+            nnext = matrix_cache.text_shape(fysum_next)[0] - cohort.n_seq
+            print('nnext:', nnext)
+            print('N:', N)
+            new_people = np.random.choice(np.arange(0, N, 1, dtype=np.int64), nnext,
+                                          replace=False)
 
         print("{} new people".format(len(new_people)), file=sys.stderr)
 
-        update_dataset(active_learning_dir, str(iiter+1), fysum_large, fysum_small, fym_large, fym_small,
-                       fyp_large, fyp_small, fxm_large, fxm_small, fxp_large, fxp_small,
-                       new_people)
+        with profiler.phase("update_dataset"):
+            update_dataset(active_learning_dir, str(iiter+1), cohort, new_people,
+                           writer=writer, dtype=dtype, archive=archive)
 
     fysum = general_prefix + to_data + active_learning_dir + \
         "/{}Ysum_small.txt".format(maxiter)
@@ -153,10 +209,19 @@ def random_learning_sim(start_ysum_large, start_ym_large, start_yp_large, start_
         "/{}Xm_small.txt".format(maxiter)
     fxp = general_prefix + to_data + active_learning_dir + \
         "/{}Xp_small.txt".format(maxiter)
-    run_citruss(fysum, fym, fyp, fxm, fxp,
-                general_prefix + to_data +
-                active_learning_dir + "/" + str(maxiter) + "random",
-                0.01, 0.01, 0.01, 0.01, to_citruss)
+    writer.close()
+    profiler.next_iteration(maxiter)
+    with profiler.phase("fit"):
+        run_citruss(fysum, fym, fyp, fxm, fxp,
+                    general_prefix + to_data +
+                    active_learning_dir + "/" + str(maxiter) + "random",
+                    0.01, 0.01, 0.01, 0.01, to_citruss, screen=screen)
+    if archive is not None:
+        archive_fit(archive, maxiter, *sparse_params.load_params(
+            general_prefix + to_data + active_learning_dir + "/" + str(maxiter) + "random"))
+        archive.close()
+    matrix_cache.report()
+    profiler.report()
 
 # ---------------------------------------------------------------------
 # Run citruss.py on a dataset; reconstruct parameters
@@ -164,27 +229,49 @@ def random_learning_sim(start_ysum_large, start_ym_large, start_yp_large, start_
 
 
 def run_citruss(fysum, fym, fyp, fxm, fxp, output_prefix,
-                vreg, freg, gammareg, psireg, citruss_path):
+                vreg, freg, gammareg, psireg, citruss_path, screen=SCREEN):
     """
     Run citruss on a dataset with the given parameters.
+    With screen, genes are fit in independent blocks where possible
+    (screening.fit_screened).
     """
     # get N, q, p
-    N, q = np.loadtxt(fysum).shape
-    _, p = np.loadtxt(fxm).shape
+    N, q = matrix_cache.text_shape(fysum)
+    _, p = matrix_cache.text_shape(fxm)
 
     cmd_list = ['python', citruss_path, str(N), str(q), str(p),
                 fysum, fym, fyp, fxm, fxp, output_prefix,
                 str(vreg), str(freg), str(gammareg), str(psireg)]
 
-    subprocess.run(cmd_list, check=True)
+    if not (screen and screening.fit_screened(fysum, fym, fyp, fxm, fxp,
+                                              output_prefix, vreg, freg,
+                                              gammareg, psireg, citruss_path)):
+        subprocess.run(cmd_list, check=True)
+
+
+def archive_fit(archive, iteration, V, F, Gamma, Psi):
+    """
+    Append a fit's parameters to the run archive (if any).
+    """
+    if archive is None:
+        return
+    for name, mat in zip(sparse_params.PARAM_NAMES, (V, F, Gamma, Psi)):
+        archive.put(iteration, "random", name, mat)
 
 
 def get_params(V, F, Gamma, Psi):
     """
     Reconstruct Omega, Xi, and Pi from the input parameters.
+    Dense F is modified in place (Xi is F); sparse inputs give sparse
+    outputs and F is left untouched.
     """
     Omega = V - Gamma
     Pi = 2 * Psi
+    if sp.issparse(F):
+        Xi = F.tocsr(copy=True)
+        Xi = Xi - Xi.multiply(Pi != 0)
+        Xi.eliminate_zeros()
+        return Omega, Xi, Pi
     Xi = F
     Xi[np.nonzero(Pi)] = 0
     return Omega, Xi, Pi
@@ -193,78 +280,31 @@ def get_params(V, F, Gamma, Psi):
 # ---------------------------------------------------------------------
 # Initialize active learning dataset, update dataset after round
 # ---------------------------------------------------------------------
-def update_dataset(outdir, outprefix,
-                   fysum_large, fysum_small,
-                   fym_large, fym_small,
-                   fyp_large, fyp_small,
-                   fxm_large, fxm_small,
-                   fxp_large, fxp_small,
-                   set_cover_people):
+def update_dataset(outdir, outprefix, cohort, set_cover_people,
+                   writer=None, dtype=np.float64, archive=None):
     """
     Adds people from set cover to new dataset of RNA-sequenced people.
     Removes people from set cover of non-RNA-sequences people.
     Inputs:
         outdir (str) - the folder in which to save the initialized dataset.
         outprefix (str) - the prefix to give the saved files
-        fysum_large (str) - the name of the file containing old Ysum_large
-        fysum_small (str) - the name of the file containing old Ysum_small
-        fym_large (str) - the name of the file containing old Ym_large
-        fym_small (str) - the name of the file containing old Ym_small
-        fyp_large (str) - the name of the file containing old Yp_large
-        fyp_small (str) - the name of the file containingm old Yp_small
-        fxm_large (str) - the name of the file containing old Xm_large
-        fxm_small (str) - the name of the file containing old Xm_small
-        fxp_large (str) - the name of the file containing old Xp_large
-        fxp_small (str) - the name of the file containing old Xp_small
-        set_cover_people (np.array) - people to be sequenced
+        cohort (Cohort) - the sequenced set and pool, updated in place
+        set_cover_people (np.array) - people to be sequenced, as rows of
+                                      the pool (the *_large files)
+        writer (AsyncWriter) - if given, files are queued on it instead of
+                               being written before returning
+        dtype (np.dtype) - precision the matrices are saved in
+        archive (RunArchive) - if given, the snapshot is also appended to it
     Outputs - none (saves files to outdir)
     """
-    ysum_large = np.loadtxt(fysum_large)
-    ysum_small = np.loadtxt(fysum_small)
-    ym_large = np.loadtxt(fym_large)
-    ym_small = np.loadtxt(fym_small)
-    yp_large = np.loadtxt(fyp_large)
-    yp_small = np.loadtxt(fyp_small)
-    xm_large = np.loadtxt(fxm_large)
-    xm_small = np.loadtxt(fxm_small)
-    xp_large = np.loadtxt(fxp_large)
-    xp_small = np.loadtxt(fxp_small)
-
-    Nr, q = ysum_large.shape
-    _, p = xp_large.shape
-
-    mask = np.zeros(Nr, dtype=bool)
-    mask[set_cover_people] = 1
-
-    ysum_small = np.vstack((ysum_small, ysum_large[mask, :]))
-    ym_small = np.vstack((ym_small, ym_large[mask, :]))
-    yp_small = np.vstack((yp_small, yp_large[mask, :]))
-    xm_small = np.vstack((xm_small, xm_large[mask, :]))
-    xp_small = np.vstack((xp_small, xp_large[mask, :]))
-
-    ysum_large = ysum_large[np.logical_not(mask), :]
-    ym_large = ym_large[np.logical_not(mask), :]
-    yp_large = yp_large[np.logical_not(mask), :]
-    xm_large = xm_large[np.logical_not(mask), :]
-    xp_large = xp_large[np.logical_not(mask), :]
-
-    np.savetxt(file_path(outdir, outprefix,
-               "Ysum_small_random.txt"), ysum_small)
-    np.savetxt(file_path(outdir, outprefix, "Ym_small_random.txt"), ym_small)
-    np.savetxt(file_path(outdir, outprefix, "Yp_small_random.txt"), yp_small)
-    np.savetxt(file_path(outdir, outprefix, "Xm_small_random.txt"), xm_small)
-    np.savetxt(file_path(outdir, outprefix, "Xp_small_random.txt"), xp_small)
-
-    np.savetxt(file_path(outdir, outprefix,
-               "Ysum_large_random.txt"), ysum_large)
-    np.savetxt(file_path(outdir, outprefix, "Ym_large_random.txt"), ym_large)
-    np.savetxt(file_path(outdir, outprefix, "Yp_large_random.txt"), yp_large)
-    np.savetxt(file_path(outdir, outprefix, "Xm_large_random.txt"), xm_large)
-    np.savetxt(file_path(outdir, outprefix, "Xp_large_random.txt"), xp_large)
+    cohort.sequence(set_cover_people)
+    save_dataset(outdir, outprefix, cohort, writer=writer, dtype=dtype,
+                 archive=archive)
 
 
 def initialize_dataset(outdir, outprefix, fysum, fym, fyp, fxm, fxp,
-                       fysum2, fym2, fyp2, fxm2, fxp2):
+                       fysum2, fym2, fyp2, fxm2, fxp2, writer=None, dtype=np.float64,
+                       archive=None):
     """
     Initialize a dataset for an active learning simulation.
     Inputs:
@@ -275,39 +315,78 @@ def initialize_dataset(outdir, outprefix, fysum, fym, fyp, fxm, fxp,
         fyp (str) - the name of the file containingm Yp
         fxm (str) - the name of the file containing Xm
         fxp (str) - the name of the file containing Xp
-    Outputs - none (saves files to outdir)
+        writer (AsyncWriter) - if given, files are queued on it instead of
+                               being written before returning
+        dtype (np.dtype) - precision the matrices are loaded and saved in
+        archive (RunArchive) - if given, the snapshot is also appended to it,
+                               and the starting split is read from the
+                               active arm's iteration 0 in it if present
+    Outputs - the cohort (Cohort) (saves files to outdir)
+    """
+    kinds = ("Ysum", "Ym", "Yp", "Xm", "Xp")
+    if archive is not None and (0, "active", "Ysum_large") in archive:
+        small = [archive.get(0, "active", kind + "_small").astype(dtype, copy=False)
+                 for kind in kinds]
+        large = [archive.get(0, "active", kind + "_large").astype(dtype, copy=False)
+                 for kind in kinds]
+    else:
+        small = [np.loadtxt(f, dtype=dtype) for f in (fysum, fym, fyp, fxm, fxp)]
+        large = [np.loadtxt(f, dtype=dtype) for f in (fysum2, fym2, fyp2, fxm2, fxp2)]
+    cohort = cohort_layout.Cohort.from_parts(small, large)
+
+    save_dataset(outdir, outprefix, cohort, writer=writer, dtype=dtype,
+                 archive=archive)
+    return cohort
+
+
+def save_dataset(outdir, outprefix, cohort, writer=None, dtype=np.float64,
+                 archive=None):
     """
-    ysum = np.loadtxt(fysum)
-    ym = np.loadtxt(fym)
-    yp = np.loadtxt(fyp)
-    xm = np.loadtxt(fxm)
-    xp = np.loadtxt(fxp)
-
-    ysum2 = np.loadtxt(fysum2)
-    ym2 = np.loadtxt(fym2)
-    yp2 = np.loadtxt(fyp2)
-    xm2 = np.loadtxt(fxm2)
-    xp2 = np.loadtxt(fxp2)
-
-    np.savetxt(file_path(outdir, outprefix,
-               "Ysum_small_random.txt"), ysum)
-    np.savetxt(file_path(outdir, outprefix, "Ym_small_random.txt"), ym)
-    np.savetxt(file_path(outdir, outprefix, "Yp_small_random.txt"), yp)
-    np.savetxt(file_path(outdir, outprefix, "Xm_small_random.txt"), xm)
-    np.savetxt(file_path(outdir, outprefix, "Xp_small_random.txt"), xp)
-
-    np.savetxt(file_path(outdir, outprefix,
-               "Ysum_large_random.txt"), ysum2)
-    np.savetxt(file_path(outdir, outprefix, "Ym_large_random.txt"), ym2)
-    np.savetxt(file_path(outdir, outprefix, "Yp_large_random.txt"), yp2)
-    np.savetxt(file_path(outdir, outprefix, "Xm_large_random.txt"), xm2)
-    np.savetxt(file_path(outdir, outprefix, "Xp_large_random.txt"), xp2)
+    Saves the sequenced set and the pool of a cohort as the *_small_random
+    and *_large_random files. With an archive, both are appended to it as
+    well and only the *_small_random files are written as text.
+    """
+    savetxt = functools.partial(matrix_cache.savetxt if writer is None else writer.savetxt,
+                                fmt=text_fmt(dtype))
+
+    ysum_small, ym_small, yp_small, xm_small, xp_small = cohort.small
+    ysum_large, ym_large, yp_large, xm_large, xp_large = cohort.large
+
+    savetxt(file_path(outdir, outprefix,
+            "Ysum_small_random.txt"), ysum_small)
+    savetxt(file_path(outdir, outprefix, "Ym_small_random.txt"), ym_small)
+    savetxt(file_path(outdir, outprefix, "Yp_small_random.txt"), yp_small)
+    savetxt(file_path(outdir, outprefix, "Xm_small_random.txt"), xm_small)
+    savetxt(file_path(outdir, outprefix, "Xp_small_random.txt"), xp_small)
+
+    if archive is not None:
+        for kind, small, large in zip(("Ysum", "Ym", "Yp", "Xm", "Xp"),
+                                      cohort.small, cohort.large):
+            archive.put(int(outprefix), "random", kind + "_small", small)
+            archive.put(int(outprefix), "random", kind + "_large", large)
+        return
+
+    savetxt(file_path(outdir, outprefix,
+            "Ysum_large_random.txt"), ysum_large)
+    savetxt(file_path(outdir, outprefix, "Ym_large_random.txt"), ym_large)
+    savetxt(file_path(outdir, outprefix, "Yp_large_random.txt"), yp_large)
+    savetxt(file_path(outdir, outprefix, "Xm_large_random.txt"), xm_large)
+    savetxt(file_path(outdir, outprefix, "Xp_large_random.txt"), xp_large)
 
 
 def file_path(outdir, outprefix, fname):
     return ''.join((outdir, '/', outprefix, fname))
 
 
+def text_fmt(dtype):
+    """
+    np.savetxt format that round-trips values of the given precision.
+    """
+    if np.dtype(dtype) == np.float32:
+        return '%.9g'
+    return '%.18e'
+
+
 # ---------------------------------------------------------------------
 # Taking subsets of the people and determining needed genes, set cover
 # ---------------------------------------------------------------------
@@ -0,0 +1,335 @@
+######################################################################
+# run_archive.py
+# One append-only file per simulation run holding every per-iteration
+# matrix (cohort snapshots and fitted parameters) of both arms, instead
+# of thousands of small text files.
+#
+# Layout:
+#   b"RUNARCH1"                                   file magic
+#   b"REC1" <uint64 n> <n bytes JSON header> <payload>   one per array
+#   b"IDX1" <uint64 n> <n bytes JSON index>       written by close()
+#   b"END1" <uint64 offset of the IDX1 block>     footer, last 12 bytes
+# A record header holds its key (iteration, arm, kind), the format
+# ("dense" or "csr") and the dtype, shape and size of each payload part;
+# dense payloads are raw C-order rows, written and readable in chunks.
+# Readers use the footer index if the file ends with one, otherwise they
+# scan the record headers once, seeking over the payloads. A later record
+# for the same key replaces the earlier one.
+#
+# Usage:
+#   python run_archive.py export ARCHIVE OUTDIR     legacy text files
+#   python run_archive.py prune ARCHIVE OUTDIR      remove archived text files
+#   python run_archive.py list ARCHIVE
+######################################################################
+
+import argparse
+import fcntl
+import json
+import os
+import struct
+
+import numpy as np
+import scipy.sparse as sp
+
+import sparse_params
+
+MAGIC = b"RUNARCH1"
+RECORD = b"REC1"
+INDEX = b"IDX1"
+FOOTER = b"END1"
+_LEN = struct.Struct("<Q")
+
+# name of the archive inside a run directory
+ARCHIVE_NAME = "run.archive"
+
+# dense payloads are written this many bytes at a time
+CHUNK_BYTES = 1 << 22
+
+
+class RunArchive:
+    """
+    Append-only container of named arrays keyed by (iteration, arm, kind).
+    Inputs:
+        path (str) - archive file
+        mode (str) - "r" to read, "a" to read and append (created if it
+                     does not exist)
+    Only one process may append to an archive at a time: opening with
+    "a" takes an exclusive lock on the file (flock, so only between
+    processes on one host) and raises IOError if another appender holds
+    it. The two simulation arms therefore cannot archive into the same
+    run concurrently; run them one after the other. close() (also
+    on leaving a with block) writes the index so the next open is a
+    single read; an archive that was not closed, e.g. after a crash, is
+    recovered by scanning and any torn last record is dropped.
+    """
+
+    def __init__(self, path, mode="r"):
+        if mode not in ("r", "a"):
+            raise ValueError("mode must be 'r' or 'a'")
+        self.path = path
+        self.mode = mode
+        self._index = {}
+        if mode == "a" and not os.path.exists(path):
+            with open(path, "wb") as f:
+                f.write(MAGIC)
+        self._f = open(path, "rb" if mode == "r" else "r+b")
+        if mode == "a":
+            try:
+                fcntl.flock(self._f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                self._f.close()
+                raise IOError("{} is being appended to by another "
+                              "process".format(path)) from None
+        if self._f.read(len(MAGIC)) != MAGIC:
+            self._f.close()
+            raise ValueError("{} is not a run archive".format(path))
+        end = self._load_index()
+        if mode == "a":
+            # drop a record torn by a crash before appending after it
+            self._f.truncate(end)
+        self._dirty = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __contains__(self, key):
+        return _key(*key) in self._index
+
+    # %% writing
+    def put(self, iteration, arm, kind, array):
+        """
+        Append a dense array or scipy.sparse matrix (stored as CSR).
+        """
+        if self.mode != "a":
+            raise IOError("archive opened read-only")
+        if sp.issparse(array):
+            csr = sp.csr_matrix(array)
+            fmt, shape = "csr", list(csr.shape)
+            parts = [csr.data, csr.indices, csr.indptr]
+        else:
+            fmt, shape = "dense", None
+            parts = [np.ascontiguousarray(array)]
+        header = {"key": [int(iteration), arm, kind], "format": fmt,
+                  "shape": shape,
+                  "parts": [{"dtype": A.dtype.str, "shape": list(A.shape),
+                             "nbytes": A.nbytes} for A in parts]}
+        raw = json.dumps(header).encode()
+
+        f = self._f
+        f.seek(0, os.SEEK_END)
+        f.write(RECORD + _LEN.pack(len(raw)) + raw)
+        offset = f.tell()
+        for A in parts:
+            _write_chunked(f, A)
+        self._index[_key(iteration, arm, kind)] = (offset, header)
+        self._dirty = True
+
+    def close(self):
+        """
+        Write the index and footer (if anything was appended) and close.
+        """
+        if self._f.closed:
+            return
+        if self.mode == "a" and self._dirty:
+            f = self._f
+            f.seek(0, os.SEEK_END)
+            start = f.tell()
+            raw = json.dumps([[offset, header] for offset, header
+                              in self._index.values()]).encode()
+            f.write(INDEX + _LEN.pack(len(raw)) + raw)
+            f.write(FOOTER + _LEN.pack(start))
+            f.flush()
+            os.fsync(f.fileno())
+        self._f.close()
+
+    # %% reading
+    def get(self, iteration, arm, kind, rows=None):
+        """
+        The array stored under the key. For dense arrays, rows (a slice
+        with step 1) reads only those rows.
+        """
+        offset, header = self._entry(iteration, arm, kind)
+        parts = header["parts"]
+        if header["format"] == "csr":
+            arrays = []
+            for part in parts:
+                arrays.append(self._read(offset, part["dtype"], part["shape"]))
+                offset += part["nbytes"]
+            return sp.csr_matrix(tuple(arrays), shape=tuple(header["shape"]))
+
+        part = parts[0]
+        shape = list(part["shape"])
+        if rows is not None and shape:
+            start, stop, step = rows.indices(shape[0])
+            if step != 1:
+                raise ValueError("rows must be a contiguous slice")
+            row_bytes = part["nbytes"] // shape[0] if shape[0] else 0
+            offset += start * row_bytes
+            shape[0] = max(0, stop - start)
+        return self._read(offset, part["dtype"], shape)
+
+    def shape(self, iteration, arm, kind):
+        """
+        Shape of a stored array, from its header only.
+        """
+        _, header = self._entry(iteration, arm, kind)
+        if header["format"] == "csr":
+            return tuple(header["shape"])
+        return tuple(header["parts"][0]["shape"])
+
+    def keys(self, arm=None, kind=None):
+        """
+        Sorted (iteration, arm, kind) keys, optionally of one arm / kind.
+        """
+        return sorted(k for k in self._index
+                      if (arm is None or k[1] == arm) and
+                      (kind is None or k[2] == kind))
+
+    def iterations(self, arm, kind):
+        return [k[0] for k in self.keys(arm, kind)]
+
+    def _entry(self, iteration, arm, kind):
+        try:
+            return self._index[_key(iteration, arm, kind)]
+        except KeyError:
+            raise KeyError("no {} for iteration {} of the {} arm in {}".format(
+                kind, iteration, arm, self.path)) from None
+
+    def _read(self, offset, dtype, shape):
+        if self.mode == "a":
+            self._f.flush()
+        self._f.seek(offset)
+        count = int(np.prod(shape)) if shape else 1
+        return np.fromfile(self._f, dtype=np.dtype(dtype), count=count).reshape(shape)
+
+    def _load_index(self):
+        """
+        Fill the index from the footer, or by scanning. Returns the end
+        of the last complete block.
+        """
+        f = self._f
+        size = f.seek(0, os.SEEK_END)
+        if size >= len(MAGIC) + 2 * (len(FOOTER) + _LEN.size):
+            f.seek(size - len(FOOTER) - _LEN.size)
+            tail = f.read(len(FOOTER) + _LEN.size)
+            if tail[:len(FOOTER)] == FOOTER:
+                f.seek(_LEN.unpack(tail[len(FOOTER):])[0])
+                tag, raw = f.read(len(INDEX)), self._read_block()
+                if tag == INDEX and raw is not None:
+                    for offset, header in json.loads(raw):
+                        self._index[_key(*header["key"])] = (offset, header)
+                    return size
+
+        pos = len(MAGIC)
+        while True:
+            f.seek(pos)
+            tag = f.read(len(RECORD))
+            if tag == FOOTER:
+                if len(f.read(_LEN.size)) < _LEN.size:
+                    return pos
+            elif tag == INDEX:
+                if self._read_block() is None:
+                    return pos
+            elif tag == RECORD:
+                raw = self._read_block()
+                if raw is None:
+                    return pos
+                header = json.loads(raw)
+                offset = f.tell()
+                end = offset + sum(part["nbytes"] for part in header["parts"])
+                if end > size:
+                    return pos
+                self._index[_key(*header["key"])] = (offset, header)
+                f.seek(end)
+            else:
+                return pos
+            pos = f.tell()
+
+    def _read_block(self):
+        raw = self._f.read(_LEN.size)
+        if len(raw) < _LEN.size:
+            return None
+        n = _LEN.unpack(raw)[0]
+        raw = self._f.read(n)
+        return raw if len(raw) == n else None
+
+
+def _key(iteration, arm, kind):
+    return (int(iteration), arm, kind)
+
+
+def _write_chunked(f, A):
+    A = A.reshape(-1)
+    step = max(1, CHUNK_BYTES // max(1, A.itemsize))
+    for start in range(0, A.size, step):
+        f.write(A[start:start + step].tobytes())
+
+
+# %% legacy text files
+def legacy_name(iteration, arm, kind):
+    """
+    File name the simulations used for this array before the archive,
+    e.g. "3Ysum_small.txt", "3Ysum_small_random.txt", "3V.txt" and
+    "3randomV.txt".
+    """
+    if kind in sparse_params.PARAM_NAMES:
+        arm_tag = "random" if arm == "random" else ""
+        return "{}{}{}.txt".format(iteration, arm_tag, kind)
+    arm_tag = "_random" if arm == "random" else ""
+    return "{}{}{}.txt".format(iteration, kind, arm_tag)
+
+
+def export_legacy(path, outdir, fmt="%.18e"):
+    """
+    Write every array of an archive to outdir under its legacy text name.
+    Returns the number of files written.
+    """
+    os.makedirs(outdir, exist_ok=True)
+    with RunArchive(path) as archive:
+        keys = archive.keys()
+        for key in keys:
+            np.savetxt(os.path.join(outdir, legacy_name(*key)),
+                       sparse_params.to_dense(archive.get(*key)), fmt=fmt)
+    return len(keys)
+
+
+def prune_legacy(path, outdir):
+    """
+    Remove the legacy text files (and sparse .npz copies of parameters)
+    in outdir whose contents are in the archive. Returns the number of
+    files removed.
+    """
+    nremoved = 0
+    with RunArchive(path) as archive:
+        for key in archive.keys():
+            fname = os.path.join(outdir, legacy_name(*key))
+            for f in (fname, os.path.splitext(fname)[0] + ".npz"):
+                if os.path.exists(f):
+                    os.remove(f)
+                    nremoved += 1
+    return nremoved
+
+
+# %% command line
+def main():
+    parser = argparse.ArgumentParser(description="Simulation run archives")
+    parser.add_argument("action", choices=["export", "prune", "list"])
+    parser.add_argument("archive")
+    parser.add_argument("outdir", nargs="?", default=".")
+    args = parser.parse_args()
+
+    if args.action == "export":
+        print("{} files written".format(export_legacy(args.archive, args.outdir)))
+    elif args.action == "prune":
+        print("{} files removed".format(prune_legacy(args.archive, args.outdir)))
+    else:
+        with RunArchive(args.archive) as archive:
+            for key in archive.keys():
+                print(*key, archive.shape(*key), sep="\t")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,222 @@
+######################################################################
+# screening.py
+# Block screening of the gene network V before a citruss fit. The genes
+# are split into the connected components of |S| > regV, S = Ysum' Ysum
+# / n the per-sample second moment of Ysum; each component is fit by
+# its own citruss run, in parallel (single genes SINGLES_PER_RUN to a
+# run), and V is reassembled block diagonal. The assembled fit is then
+# checked against the optimality conditions of the joint problem, and
+# blocks joined by a violated condition are merged and refit until none
+# is left.
+#
+# citruss (from Mega-sCGGM) minimises the per-sample objective, i.e.
+# 2 / n times the summed negative log-likelihood of the CGGM
+#   Ysum | Xs ~ N(V^-1 F' xs / 2, V^-1)
+# plus regV |V|_1 + regF |F|_1 (+ the Gamma, Psi terms), so regV is
+# compared with S directly. Its gradient in V is
+#   S - M' M / n - V^-1,   M = Xs F V^-1 / 2 the fitted means,
+# and for a block diagonal V the F terms of one block involve only that
+# block, as do the (diagonal) Gamma and Psi terms. A zero V_ij between
+# two blocks is therefore optimal for the joint problem iff
+#   |S_ij - (M' M)_ij / n| <= regV,
+# which is what the check below tests; the initial split is this rule
+# at F = 0. The result is the joint fit up to the tolerance of citruss
+# (KKT_TOL). With SCREEN off (the default) citruss fits all genes at
+# once.
+######################################################################
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import scipy.sparse as sp
+from scipy.sparse import csgraph
+
+import matrix_cache
+import sparse_params
+
+# genes without a neighbour are fit together, at most this many per
+# citruss run
+SINGLES_PER_RUN = 32
+
+# citruss solves each block only approximately; a cross-block gradient
+# up to regV (1 + KKT_TOL) still counts as satisfying the condition
+KKT_TOL = 1e-3
+
+
+# %% components
+def empirical_covariance(Ysum):
+    """
+    S = Ysum' Ysum / n (the model has no intercept, so no centring).
+    """
+    Ysum = np.asarray(Ysum, dtype=np.float64)
+    return Ysum.T @ Ysum / Ysum.shape[0]
+
+
+def screening_edges(Ysum, regV):
+    """
+    Boolean q x q matrix with True where |S_ij| > regV, i.e. where the
+    optimality condition of a zero V_ij fails at F = 0.
+    """
+    return np.abs(empirical_covariance(Ysum)) > regV
+
+
+def gene_blocks(edges):
+    """
+    Connected components of the graph with the given adjacency, with the
+    single genes gathered into blocks of up to SINGLES_PER_RUN, each fit
+    by one citruss run.
+    Outputs:
+        blocks (list) - sorted gene indices of each block, largest first
+    """
+    ncomp, labels = csgraph.connected_components(sp.csr_matrix(edges),
+                                                 directed=False)
+    order = np.argsort(labels, kind='stable')
+    comps = np.split(order, np.cumsum(np.bincount(labels, minlength=ncomp))[:-1])
+    blocks = [c for c in comps if len(c) > 1]
+    singles = [c for c in comps if len(c) == 1]
+    if singles:
+        singles = np.sort(np.concatenate(singles))
+        blocks += np.array_split(singles, -(-len(singles) // SINGLES_PER_RUN))
+    return sorted(blocks, key=len, reverse=True)
+
+
+def kkt_violations(Xs, Ysum, V, F, blocks, regV, tol=KKT_TOL):
+    """
+    Boolean q x q matrix with True for the gene pairs in different
+    blocks whose zero V_ij is not optimal for the joint fit, i.e.
+    |S_ij - (M' M)_ij / n| > regV (1 + tol).
+    """
+    Ysum = np.asarray(Ysum, dtype=np.float64)
+    M = np.empty_like(Ysum)
+    labels = np.empty(Ysum.shape[1], dtype=np.int64)
+    for k, genes in enumerate(blocks):
+        labels[genes] = k
+        # V is symmetric, so Xs F V^-1 = (V^-1 (Xs F)')'
+        M[:, genes] = np.linalg.solve(V[np.ix_(genes, genes)],
+                                      (Xs @ F[:, genes]).T).T / 2
+    G = empirical_covariance(Ysum) - M.T @ M / Ysum.shape[0]
+    return (np.abs(G) > regV * (1 + tol)) & \
+        (labels[:, None] != labels[None, :])
+
+
+# %% screened fit
+def fit_screened(fysum, fym, fyp, fxm, fxp, output_prefix,
+                 vreg, freg, gammareg, psireg, citruss_path, workers=None):
+    """
+    Fit citruss block by block, writing V, F, Gamma and Psi under
+    output_prefix exactly as a single citruss run would.
+    Inputs:
+        workers (int) - citruss runs at a time (one thread each); None
+                        for one per CPU
+    Outputs:
+        nblocks (int) - number of blocks; 0 if screening does not split
+                        the genes, in which case nothing is written and
+                        the caller runs citruss as usual
+    """
+    Ysum = matrix_cache.load_matrix(fysum)
+    Ysum = Ysum.reshape(Ysum.shape[0], -1)
+    edges = screening_edges(Ysum, vreg)
+    blocks = gene_blocks(edges)
+    if len(blocks) == 1:
+        return 0
+
+    Ym = matrix_cache.load_matrix(fym).reshape(Ysum.shape)
+    Yp = matrix_cache.load_matrix(fyp).reshape(Ysum.shape)
+    Xm = matrix_cache.load_matrix(fxm)
+    Xp = matrix_cache.load_matrix(fxp)
+    Xm = Xm.reshape(Xm.shape[0], -1)
+    Xs = Xm + Xp.reshape(Xm.shape)
+    N, q = Ysum.shape
+    p = Xm.shape[1]
+
+    # block fits by gene tuple, kept across merges
+    fits = {}
+    tmpdir = tempfile.mkdtemp(prefix="screen_",
+                              dir=os.path.dirname(os.path.abspath(output_prefix)))
+    try:
+        while True:
+            todo = [b for b in blocks if tuple(b) not in fits]
+            fits.update(fit_blocks(todo, Ysum, Ym, Yp, fxm, fxp, p, vreg, freg,
+                                   gammareg, psireg, citruss_path, tmpdir,
+                                   workers))
+            V, F, Gamma, Psi = assemble(blocks, fits, p, q)
+            try:
+                violated = kkt_violations(Xs, Ysum, V, F, blocks, vreg)
+            except np.linalg.LinAlgError:
+                print("screening: singular block fit, fitting all genes at once",
+                      file=sys.stderr)
+                return 0
+            if not violated.any():
+                break
+            edges |= violated
+            blocks = gene_blocks(edges)
+            print("screening: {} cross-block conditions violated, merging "
+                  "into {} blocks".format(int(violated.sum()) // 2,
+                                          len(blocks)), file=sys.stderr)
+            if len(blocks) == 1:
+                return 0
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    print("screening: {} genes in {} blocks (largest {})".format(
+        q, len(blocks), len(blocks[0])), file=sys.stderr)
+
+    for name, mat in zip(sparse_params.PARAM_NAMES, (V, F, Gamma, Psi)):
+        fname = output_prefix + name + ".txt"
+        matrix_cache.savetxt(fname, mat)
+        fnpz = output_prefix + name + ".npz"
+        if os.path.exists(fnpz):
+            os.remove(fnpz)
+    return len(blocks)
+
+
+def fit_blocks(blocks, Ysum, Ym, Yp, fxm, fxp, p, vreg, freg, gammareg,
+               psireg, citruss_path, tmpdir, workers=None):
+    """
+    Fit each block with its own citruss run, workers at a time.
+    Outputs:
+        fits (dict) - {tuple(genes): (V_b, F_b, Gamma_b, Psi_b)}
+    """
+    N = Ysum.shape[0]
+
+    def fit_block(genes):
+        prefix = os.path.join(tmpdir, "{}_".format(genes[0]))
+        files = []
+        for name, Y in (("Ysum", Ysum), ("Ym", Ym), ("Yp", Yp)):
+            files.append(prefix + name + ".txt")
+            np.savetxt(files[-1], Y[:, genes])
+        cmd_list = ['python', citruss_path, str(N), str(len(genes)), str(p),
+                    *files, fxm, fxp, prefix,
+                    str(vreg), str(freg), str(gammareg), str(psireg)]
+        subprocess.run(cmd_list, check=True)
+        V_b, F_b, Gamma_b, Psi_b = [np.loadtxt(prefix + name + ".txt", ndmin=2)
+                                    for name in sparse_params.PARAM_NAMES]
+        return (V_b, F_b.reshape(p, len(genes)), Gamma_b,
+                Psi_b.reshape(p, len(genes)))
+
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        return {tuple(genes): fit for genes, fit in
+                zip(blocks, pool.map(fit_block, blocks))}
+
+
+def assemble(blocks, fits, p, q):
+    """
+    Dense V, F, Gamma and Psi from the fits of the given blocks.
+    """
+    V = np.zeros((q, q))
+    F = np.zeros((p, q))
+    Gamma = np.zeros((q, q))
+    Psi = np.zeros((p, q))
+    for genes in blocks:
+        V_b, F_b, Gamma_b, Psi_b = fits[tuple(genes)]
+        block = np.ix_(genes, genes)
+        V[block] = V_b
+        F[:, genes] = F_b
+        Gamma[block] = Gamma_b
+        Psi[:, genes] = Psi_b
+    return V, F, Gamma, Psi
@@ -0,0 +1,116 @@
+######################################################################
+# sparse_params.py
+# Sparse storage and loading of the fitted CGGM parameters
+# (V, F, Gamma, Psi) written by citruss.
+######################################################################
+
+import os
+import numpy as np
+import scipy.sparse as sp
+
+PARAM_NAMES = ("V", "F", "Gamma", "Psi")
+
+# save a sparse .npz copy next to each parsed text parameter so later
+# loads skip the parse; off by default, as it doubles the number of
+# parameter files a run leaves on disk
+SAVE_NPZ = False
+
+
+# %% loading and saving
+def load_params(prefix, save_npz=SAVE_NPZ):
+    """
+    Load the fitted parameters written by citruss under output prefix
+    prefix as CSR matrices (see load_param).
+    Outputs:
+        (V, F, Gamma, Psi) - scipy.sparse.csr_matrix
+    """
+    return tuple(load_param(prefix, name, save_npz=save_npz)
+                 for name in PARAM_NAMES)
+
+
+def load_param(prefix, name, save_npz=SAVE_NPZ):
+    """
+    Load one fitted parameter as a CSR matrix. The sparse file
+    {prefix}{name}.npz is used if present and up to date; otherwise the
+    dense text file {prefix}{name}.txt written by citruss is parsed,
+    and with save_npz the sparse copy is saved next to it for later
+    loads.
+    """
+    fnpz = prefix + name + ".npz"
+    ftxt = prefix + name + ".txt"
+    if os.path.exists(fnpz) and \
+            (not os.path.exists(ftxt) or
+             os.path.getmtime(fnpz) >= os.path.getmtime(ftxt)):
+        return sp.load_npz(fnpz).tocsr()
+    mat = text_to_sparse(ftxt)
+    if save_npz:
+        save_param(prefix, name, mat)
+    return mat
+
+
+def save_param(prefix, name, mat):
+    """
+    Save a parameter matrix (dense or sparse) as {prefix}{name}.npz.
+    """
+    sp.save_npz(prefix + name + ".npz", sp.csr_matrix(mat))
+
+
+def convert_params(prefix):
+    """
+    Convert all dense text parameters under prefix to sparse .npz files.
+    """
+    for name in PARAM_NAMES:
+        save_param(prefix, name, text_to_sparse(prefix + name + ".txt"))
+
+
+def text_to_sparse(fname):
+    """
+    Parse a dense whitespace-delimited text matrix into a CSR matrix one
+    row at a time, keeping only the non-zero entries.
+    """
+    rows, cols, vals = [], [], []
+    nrow, ncol = 0, 0
+    with open(fname) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            row = np.array(line.split(), dtype=np.float64)
+            ncol = len(row)
+            nz = np.flatnonzero(row)
+            rows.append(np.full(len(nz), nrow, dtype=np.int64))
+            cols.append(nz)
+            vals.append(row[nz])
+            nrow += 1
+    if nrow == 0:
+        return sp.csr_matrix((0, 0))
+    return sp.csr_matrix((np.concatenate(vals),
+                          (np.concatenate(rows), np.concatenate(cols))),
+                         shape=(nrow, ncol))
+
+
+# %% helpers working on dense and sparse matrices alike
+def support(mat):
+    """
+    Row and column indices of the non-zero entries of mat.
+    """
+    if sp.issparse(mat):
+        return mat.nonzero()
+    return np.nonzero(mat)
+
+
+def nnz(mat):
+    """
+    Number of non-zero entries of mat.
+    """
+    if sp.issparse(mat):
+        return mat.count_nonzero()
+    return np.count_nonzero(mat)
+
+
+def to_dense(mat):
+    """
+    Dense ndarray copy of a sparse matrix; dense inputs are returned as is.
+    """
+    if sp.issparse(mat):
+        return mat.toarray()
+    return mat
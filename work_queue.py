@@ -0,0 +1,307 @@
+######################################################################
+# work_queue.py
+# Filesystem work queue for running citruss fits and BIC scorings on
+# several nodes that share a filesystem, without a job broker.
+#
+# Layout of a spool directory:
+#   tmp/      job specs being written
+#   pending/  jobs waiting for a worker
+#   claimed/  jobs being run, as {job id}.{worker token}.json; file mtime
+#             is the worker's heartbeat
+#   done/     finished jobs, with their result
+#   failed/   jobs that raised, with the traceback
+# Jobs move between directories with os.rename, which is atomic on a
+# single filesystem, so exactly one worker wins each claim. The token in
+# a claimed name is unique to the worker process, so a worker whose job
+# was requeued and claimed again by another never touches the new claim.
+#
+# Usage:
+#   python work_queue.py worker SPOOL [--lease SECONDS] [--idle-exit SECONDS]
+#   python work_queue.py local SPOOL NWORKERS
+#   python work_queue.py requeue SPOOL [--lease SECONDS]
+#   python work_queue.py status SPOOL
+######################################################################
+
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+import traceback
+import uuid
+
+# seconds without a heartbeat after which a claimed job is requeued
+LEASE = 300
+# seconds between polls of an empty queue
+POLL = 5
+
+SUBDIRS = ("tmp", "pending", "claimed", "done", "failed")
+
+
+# %% submitting and collecting jobs
+def init_spool(spool):
+    """
+    Create the spool directory layout if it does not exist yet.
+    """
+    for sub in SUBDIRS:
+        os.makedirs(os.path.join(spool, sub), exist_ok=True)
+
+
+def submit(spool, kind, args):
+    """
+    Add a job to the queue.
+    Inputs:
+        spool (str) - spool directory
+        kind (str) - "citruss", "bic" or "command" (see execute_job)
+        args (dict) - JSON-serialisable job arguments
+    Outputs:
+        job_id (str) - name of the job file, sortable by submission time
+    """
+    init_spool(spool)
+    job_id = "{:020d}-{}".format(time.time_ns(), uuid.uuid4().hex[:8])
+    job = {"id": job_id, "kind": kind, "args": args,
+           "submitted": time.time()}
+    tmp = os.path.join(spool, "tmp", job_id + ".json")
+    with open(tmp, "w") as f:
+        json.dump(job, f)
+    os.rename(tmp, os.path.join(spool, "pending", job_id + ".json"))
+    return job_id
+
+
+def collect_results(spool):
+    """
+    Returns {job_id: job} for all finished jobs; each job has its
+    "result" filled in by the worker that ran it.
+    """
+    results = {}
+    done_dir = os.path.join(spool, "done")
+    for fname in sorted(os.listdir(done_dir)):
+        with open(os.path.join(done_dir, fname)) as f:
+            job = json.load(f)
+        results[job["id"]] = job
+    return results
+
+
+def status(spool):
+    """
+    Returns the number of jobs in each state.
+    """
+    return {sub: len(os.listdir(os.path.join(spool, sub)))
+            for sub in SUBDIRS if sub != "tmp"}
+
+
+# %% claiming jobs and lease expiry
+def claim(spool, token):
+    """
+    Atomically claim the oldest pending job for the worker with the given
+    token. Returns the path of the claimed job file, or None if the queue
+    is empty.
+    """
+    pending_dir = os.path.join(spool, "pending")
+    for fname in sorted(os.listdir(pending_dir)):
+        src = os.path.join(pending_dir, fname)
+        dst = os.path.join(spool, "claimed", claimed_name(fname, token))
+        try:
+            # refresh the mtime first so the lease starts at the claim
+            os.utime(src)
+            os.rename(src, dst)
+        except FileNotFoundError:
+            # another worker got there first
+            continue
+        return dst
+    return None
+
+
+def claimed_name(fname, token):
+    """
+    {job id}.{token}.json for the job file {job id}.json.
+    """
+    return "{}.{}.json".format(job_file(fname)[:-len(".json")], token)
+
+
+def job_file(fname):
+    """
+    {job id}.json for a pending, claimed, done or failed job file name.
+    """
+    return fname.split(".", 1)[0] + ".json"
+
+
+def requeue_expired(spool, lease=LEASE):
+    """
+    Move claimed jobs whose heartbeat is older than lease seconds back to
+    pending; their workers are assumed to have crashed. Returns the
+    number of jobs requeued.
+    """
+    claimed_dir = os.path.join(spool, "claimed")
+    now = time.time()
+    nrequeued = 0
+    for fname in os.listdir(claimed_dir):
+        src = os.path.join(claimed_dir, fname)
+        try:
+            if now - os.path.getmtime(src) < lease:
+                continue
+            os.rename(src, os.path.join(spool, "pending", job_file(fname)))
+        except FileNotFoundError:
+            continue
+        print("requeued expired job {}".format(fname), file=sys.stderr)
+        nrequeued += 1
+    return nrequeued
+
+
+class Heartbeat:
+    """
+    Touches a claimed job file every interval seconds from a background
+    thread. lost is set if the file disappears, i.e. the job was
+    requeued after the lease expired.
+    """
+
+    def __init__(self, path, interval):
+        self.path = path
+        self.interval = interval
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                os.utime(self.path)
+            except FileNotFoundError:
+                self.lost = True
+                return
+
+
+# %% running jobs
+def execute_job(job):
+    """
+    Run one job and return its JSON-serialisable result.
+        citruss - args["cmd"] is the citruss command list
+        command - args["cmd"] is any command list
+        bic     - args holds the keyword arguments of BIC_selection.get_BIC,
+                  with the data given by file name only
+    """
+    kind, args = job["kind"], job["args"]
+    if kind in ("citruss", "command"):
+        subprocess.run(args["cmd"], check=True)
+        return None
+    if kind == "bic":
+        import BIC_selection
+        import matrix_cache
+        # a worker scores many grid points on the same data; parse it once
+        data = {name: matrix_cache.load_matrix(args[fname]) for name, fname in
+                (("Xm", "fXm"), ("Xp", "fXp"), ("Ym", "fYm"),
+                 ("Yp", "fYp"), ("Ysum", "fYsum"))}
+        (bic, k), llik_val = BIC_selection.get_BIC(**args, **data)
+        return {"bic": float(bic), "k": int(k), "llik": float(llik_val)}
+    raise ValueError("unknown job kind: {}".format(kind))
+
+
+def run_worker(spool, lease=LEASE, poll=POLL, idle_exit=None):
+    """
+    Claim and run jobs until the queue stays empty for idle_exit seconds
+    (forever if idle_exit is None). Returns the number of jobs run.
+    """
+    init_spool(spool)
+    worker = "{}:{}".format(socket.gethostname(), os.getpid())
+    # tells this worker's claims apart from a later claim of the same job
+    token = uuid.uuid4().hex
+    njobs = 0
+    idle_since = time.time()
+    while True:
+        requeue_expired(spool, lease)
+        path = claim(spool, token)
+        if path is None:
+            if idle_exit is not None and time.time() - idle_since > idle_exit:
+                return njobs
+            time.sleep(poll)
+            continue
+
+        with open(path) as f:
+            job = json.load(f)
+        job["worker"] = worker
+        job["started"] = time.time()
+        with Heartbeat(path, lease / 3) as heartbeat:
+            try:
+                job["result"] = execute_job(job)
+                state = "done"
+            except Exception:
+                job["error"] = traceback.format_exc()
+                state = "failed"
+        job["finished"] = time.time()
+        njobs += 1
+        idle_since = time.time()
+
+        if heartbeat.lost or not finish(spool, path, job, state):
+            print("lost lease on job {}; result discarded".format(job["id"]),
+                  file=sys.stderr)
+
+
+def finish(spool, path, job, state):
+    """
+    Record a finished job under done/ or failed/. Returns False if the
+    claim was lost in the meantime (the job has been requeued).
+    """
+    fname = job_file(os.path.basename(path))
+    tmp = os.path.join(spool, "tmp", fname + "." + uuid.uuid4().hex[:8])
+    with open(tmp, "w") as f:
+        json.dump(job, f)
+    try:
+        # taking the claimed file out first makes the finish atomic
+        # with respect to requeue_expired
+        os.rename(path, tmp + ".claimed")
+    except FileNotFoundError:
+        os.remove(tmp)
+        return False
+    os.rename(tmp, os.path.join(spool, state, fname))
+    os.remove(tmp + ".claimed")
+    return True
+
+
+def run_local_workers(spool, nworkers, lease=LEASE, poll=POLL, idle_exit=POLL):
+    """
+    Run nworkers worker processes on this machine until the queue is
+    drained; useful for small sweeps and for testing the queue.
+    """
+    cmd = [sys.executable, os.path.abspath(__file__), "worker", spool,
+           "--lease", str(lease), "--poll", str(poll),
+           "--idle-exit", str(idle_exit)]
+    procs = [subprocess.Popen(cmd) for _ in range(nworkers)]
+    for proc in procs:
+        proc.wait()
+
+
+# %% command line
+def main():
+    parser = argparse.ArgumentParser(description="Filesystem work queue")
+    parser.add_argument("action", choices=["worker", "local", "requeue", "status"])
+    parser.add_argument("spool")
+    parser.add_argument("nworkers", nargs="?", type=int, default=1)
+    parser.add_argument("--lease", type=float, default=LEASE)
+    parser.add_argument("--poll", type=float, default=POLL)
+    parser.add_argument("--idle-exit", type=float, default=None)
+    args = parser.parse_args()
+
+    init_spool(args.spool)
+    if args.action == "worker":
+        run_worker(args.spool, args.lease, args.poll, args.idle_exit)
+    elif args.action == "local":
+        run_local_workers(args.spool, args.nworkers, args.lease, args.poll,
+                          args.poll if args.idle_exit is None else args.idle_exit)
+    elif args.action == "requeue":
+        requeue_expired(args.spool, args.lease)
+    print(status(args.spool))
+
+
+if __name__ == '__main__':
+    main()